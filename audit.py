@@ -0,0 +1,271 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+from collections import deque
+from database import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: no locking, but serve.py (fork) doesn't run there either, so one process owns the journal
+    fcntl = None
+
+QUEUE_SIZE = int(os.environ.get("AUDIT_QUEUE_SIZE", 10000))
+BATCH_SIZE = int(os.environ.get("AUDIT_BATCH_SIZE", 200))
+FLUSH_INTERVAL = float(os.environ.get("AUDIT_FLUSH_INTERVAL", 1.0))
+JOURNAL_PATH = os.environ.get("AUDIT_JOURNAL_PATH", os.path.join(os.path.dirname(__file__), "data", "audit_journal.jsonl"))
+# Replay attempts back off up to this long while the database keeps failing
+MAX_REPLAY_BACKOFF = 60.0
+
+
+class AuditWriter:
+    """Write-behind buffer for verification_events.
+
+    submit() never waits on the database: rows go into a bounded in-memory
+    queue that a background task flushes in bulk every FLUSH_INTERVAL seconds
+    or as soon as BATCH_SIZE rows are waiting. When the queue is full or a
+    flush fails, rows are appended to a local JSONL journal instead, which is
+    replayed on startup and whenever the database is healthy again. Journal
+    I/O runs in a thread so a slow disk doesn't stall the event loop.
+
+    Every row carries a client_event_id, so replaying a batch that actually
+    made it to the database before a timeout doesn't duplicate it.
+
+    Workers started by serve.py share one journal: appends hold an flock on
+    the file, and only one process at a time replays it (journal.lock).
+    """
+
+    def __init__(self, table="verification_events", max_queue=QUEUE_SIZE, batch_size=BATCH_SIZE,
+                 flush_interval=FLUSH_INTERVAL, journal_path=JOURNAL_PATH):
+        self.table = table
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self.queue = deque()
+        self.overflow = []  # rows that arrived with the queue full, spilled by the background task (< batch_size)
+        self.wakeup = None
+        self.task = None
+        self.stopping = False
+        self.flush_lock = None
+        self.replay_delay = 0.0
+        self.next_replay = 0.0
+        # Counters
+        self.submitted = 0
+        self.written = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.flush_failures = 0
+
+    def submit(self, row):
+        row.setdefault("client_event_id", str(uuid.uuid4()))
+        self.submitted += 1
+        if len(self.queue) >= self.max_queue:
+            # Backpressure: goes to disk instead of the queue, written off the request path
+            if self.wakeup is None:
+                self._spill([row])
+                return
+            self.overflow.append(row)
+            if len(self.overflow) >= self.batch_size:
+                # The background task is stuck in a slow flush and can't spill: don't let overflow
+                # grow with it. One journal append per batch of rows, on the request path
+                rows, self.overflow = self.overflow, []
+                self._spill(rows)
+                return
+            self.wakeup.set()
+            return
+        self.queue.append(row)
+        if len(self.queue) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+
+    async def start(self):
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.flush_lock = asyncio.Lock()
+        await self.replay()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            # A flag rather than task.cancel(): wait_for() can swallow a cancel that
+            # lands as the wakeup event fires, leaving shutdown waiting forever
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+        # Drain what's left; anything the database refuses ends up in the journal
+        await self._spill_overflow()
+        await self.flush()
+        if self.queue:
+            rows = list(self.queue)
+            self.queue.clear()
+            await asyncio.to_thread(self._spill, rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopping:
+                return
+            try:
+                await self._spill_overflow()
+                await self.flush()
+            except Exception as e:
+                print(f"Audit flush error: {e}")
+
+    async def flush(self):
+        async with self.flush_lock:
+            while self.queue:
+                batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+                if not await self._write(batch):
+                    self.flush_failures += 1
+                    await asyncio.to_thread(self._spill, batch)
+                    return
+                self.written += len(batch)
+            # Database is keeping up again; drain anything spilled earlier
+            if self._journal_pending() and time.monotonic() >= self.next_replay:
+                await self.replay()
+
+    async def _spill_overflow(self):
+        if self.overflow:
+            rows, self.overflow = self.overflow, []
+            await asyncio.to_thread(self._spill, rows)
+
+    async def _write(self, rows):
+        try:
+            await db.table(self.table).upsert(rows, on_conflict="client_event_id", ignore_duplicates=True).execute()
+            return True
+        except Exception as e:
+            print(f"Failed to log {len(rows)} events: {e}")
+            return False
+
+    # --- Journal ---
+
+    def _spill(self, rows):
+        try:
+            os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+            self._append(rows)
+            self.spilled += len(rows)
+        except OSError as e:
+            print(f"Audit journal write failed, dropping {len(rows)} events: {e}")
+            self.dropped += len(rows)
+
+    def _append(self, rows):
+        while True:
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                    # Moved aside for replay while we waited: write to the fresh journal instead
+                    try:
+                        if os.fstat(f.fileno()).st_ino != os.stat(self.journal_path).st_ino:
+                            continue
+                    except FileNotFoundError:
+                        continue
+                for row in rows:
+                    f.write(json.dumps(row, default=str) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                return
+
+    def _journal_pending(self):
+        for path in (self.journal_path + ".replay", self.journal_path):
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                return True
+        return False
+
+    def _lock_replay(self):
+        # Returns the held lock file, or None when another process is replaying
+        if fcntl is None:
+            return True
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        lock = open(self.journal_path + ".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    def _take_journal(self):
+        replay_path = self.journal_path + ".replay"
+        # A leftover .replay file means we stopped mid-replay last time
+        if not os.path.exists(replay_path):
+            if not os.path.exists(self.journal_path) or os.path.getsize(self.journal_path) == 0:
+                return None
+            # Move aside so new spills during the replay go to a fresh journal; under the
+            # journal's lock, so an append in progress lands before the rename
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                os.replace(self.journal_path, replay_path)
+
+        rows = []
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    # Torn last line from a crash mid-write
+                    continue
+        return rows
+
+    def _keep_for_replay(self, rows):
+        replay_path = self.journal_path + ".replay"
+        tmp_path = replay_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps(row, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, replay_path)
+
+    async def replay(self):
+        lock = await asyncio.to_thread(self._lock_replay)
+        if lock is None:
+            return
+        try:
+            await self._replay()
+        finally:
+            if lock is not True:
+                lock.close()
+
+    async def _replay(self):
+        rows = await asyncio.to_thread(self._take_journal)
+        if rows is None:
+            return
+
+        for i in range(0, len(rows), self.batch_size):
+            chunk = rows[i:i + self.batch_size]
+            if not await self._write(chunk):
+                self.flush_failures += 1
+                # Still down: back off, and keep what's left for the next attempt
+                self.replay_delay = min(max(self.flush_interval, self.replay_delay * 2), MAX_REPLAY_BACKOFF)
+                self.next_replay = time.monotonic() + self.replay_delay
+                if i > 0:
+                    await asyncio.to_thread(self._keep_for_replay, rows[i:])
+                return
+            self.replayed += len(chunk)
+        self.replay_delay = 0.0
+        self.next_replay = 0.0
+        await asyncio.to_thread(os.remove, self.journal_path + ".replay")
+
+    def stats(self):
+        return {
+            "queue_depth": len(self.queue) + len(self.overflow),
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "written": self.written,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "replayed": self.replayed,
+            "flush_failures": self.flush_failures,
+            "journal_pending": self._journal_pending(),
+        }
+
+
+writer = AuditWriter()
@@ -4,3 +4,4 @@ set -o errexit
 
 pip install -r requirements.txt
 python scripts/setup_vendor.py
+python scripts/build_assets.py
@@ -0,0 +1,202 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from database import db
+from label_table import label_table
+
+CACHE_SIZE = int(os.environ.get("LABEL_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("LABEL_CACHE_TTL", 300))
+
+
+class TTLCache:
+    """Bounded LRU cache with per-entry TTL and single-flight loading.
+
+    Misses for the same key that arrive while a load is running await the
+    same future instead of each querying the database. `None` results are
+    cached too, so unknown labels don't hit the database on every scan.
+    """
+
+    def __init__(self, name, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.inflight = {}            # key -> Future
+        self.bulk_pending = {}        # key -> number of get_many loads in flight
+        self.bulk_stale = set()       # keys invalidated while a get_many load was running
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.coalesced = 0
+
+    def get(self, key):
+        # Returns (found, value)
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        # A load started before the write must not repopulate the old value
+        self.inflight.pop(key, None)
+        if key in self.bulk_pending:
+            self.bulk_stale.add(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.inflight.clear()
+
+    async def get_or_load(self, key, loader):
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            return value
+
+        fut = self.inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            return await asyncio.shield(fut)
+
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self.inflight[key] = fut
+        try:
+            value = await loader(key)
+        except Exception as e:
+            if self.inflight.get(key) is fut:
+                del self.inflight[key]
+            fut.set_exception(e)
+            # Mark retrieved so waiter-less failures don't log "exception never retrieved"
+            fut.exception()
+            raise
+        if self.inflight.get(key) is fut:
+            del self.inflight[key]
+            self.set(key, value)
+        fut.set_result(value)
+        return value
+
+    async def get_many(self, keys, loader):
+        # loader(missing_keys) -> {key: value}; keys absent from the result are cached as None
+        out = {}
+        missing = []
+        for key in keys:
+            found, value = self.get(key)
+            if found:
+                self.hits += 1
+                out[key] = value
+            else:
+                missing.append(key)
+        if missing:
+            self.misses += len(missing)
+            for key in missing:
+                self.bulk_pending[key] = self.bulk_pending.get(key, 0) + 1
+            try:
+                loaded = await loader(missing)
+            finally:
+                stale = set()
+                for key in missing:
+                    self.bulk_pending[key] -= 1
+                    if not self.bulk_pending[key]:
+                        del self.bulk_pending[key]
+                        if key in self.bulk_stale:
+                            self.bulk_stale.discard(key)
+                            stale.add(key)
+                    elif key in self.bulk_stale:
+                        stale.add(key)
+            for key in missing:
+                value = loaded.get(key)
+                if key not in stale:
+                    self.set(key, value)
+                out[key] = value
+        return out
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "name": self.name,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "coalesced": self.coalesced,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+# label_id -> {"bound_serial_norm", "active"} (or None)
+label_cache = TTLCache("labels")
+# serial_norm -> device row (or None)
+device_cache = TTLCache("devices")
+
+
+async def _load_label(label_id):
+    res = await db.table("labels").select("label_id, bound_serial_norm, active").eq("label_id", label_id).execute()
+    return res.data[0] if res.data else None
+
+
+async def _load_labels(label_ids):
+    res = await db.table("labels").select("label_id, bound_serial_norm, active").in_("label_id", label_ids).execute()
+    return {r['label_id']: r for r in res.data}
+
+
+async def _load_device(serial_norm):
+    res = await db.table("devices").select("*").eq("serial_norm", serial_norm).execute()
+    return res.data[0] if res.data else None
+
+
+async def _load_devices(serials):
+    res = await db.table("devices").select("*").in_("serial_norm", serials).execute()
+    return {r['serial_norm']: r for r in res.data}
+
+
+async def get_label(label_id):
+    return await label_cache.get_or_load(label_id, _load_label)
+
+
+async def get_labels(label_ids):
+    return await label_cache.get_many(list(label_ids), _load_labels)
+
+
+async def get_bound_serial(label_id):
+    # Active binding only, as used by verification; served from the shared table once mapped
+    if label_table.ready:
+        return label_table.bound_serial(label_id)
+    label = await get_label(label_id)
+    if label and label.get('active'):
+        return label['bound_serial_norm']
+    return None
+
+
+async def get_bound_serials(label_ids):
+    if label_table.ready:
+        return {label_id: label_table.bound_serial(label_id) for label_id in label_ids}
+    labels = await get_labels(label_ids)
+    return {label_id: l['bound_serial_norm'] if l and l.get('active') else None for label_id, l in labels.items()}
+
+
+async def get_device(serial_norm):
+    return await device_cache.get_or_load(serial_norm, _load_device)
+
+
+async def get_devices(serials):
+    return await device_cache.get_many(list(serials), _load_devices)
+
+
+def stats():
+    return [label_cache.stats(), device_cache.stats()]
@@ -1,14 +1,539 @@
 import os
-from supabase import create_client, Client
+import asyncio
+import random
+import time
+import datetime
+import httpx
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 
-if not url or not key:
-    print("Warning: SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not found in environment variables.")
-    supabase: Client = None
-else:
-    supabase: Client = create_client(url, key)
+# Pool / retry tuning for the PostgREST client
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 20))
+TIMEOUT = float(os.environ.get("DB_TIMEOUT", 10))
+RETRIES = int(os.environ.get("DB_RETRIES", 3))
+
+# Gateway errors worth retrying (Supabase/PostgREST restarting, proxy hiccups)
+TRANSIENT_STATUS = {502, 503, 504}
+
+
+class DatabaseError(Exception):
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Response:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+
+
+class Query:
+    """Chainable query in the same shape as supabase-py, but awaited:
+
+        res = await db.table("labels").select("*").eq("label_id", x).execute()
+    """
+
+    def __init__(self, backend, table):
+        self.backend = backend
+        self.table = table
+        self.method = "select"
+        self.columns = "*"
+        self.payload = None
+        self.filters = []  # (column, op, value)
+        self.orders = []   # (column, desc)
+        self.limit_count = None
+        self.offset_count = None
+        self.on_conflict = None
+        self.ignore_duplicates = False
+        self.count = None
+
+    def select(self, columns="*", count=None):
+        self.columns = columns
+        self.count = count
+        return self
+
+    def insert(self, rows):
+        self.method = "insert"
+        self.payload = rows
+        return self
+
+    def upsert(self, rows, on_conflict=None, ignore_duplicates=False):
+        self.method = "upsert"
+        self.payload = rows
+        self.on_conflict = on_conflict
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, values):
+        self.method = "update"
+        self.payload = values
+        return self
+
+    def delete(self):
+        self.method = "delete"
+        return self
+
+    def _filter(self, column, op, value):
+        self.filters.append((column, op, value))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, "eq", value)
+
+    def neq(self, column, value):
+        return self._filter(column, "neq", value)
+
+    def gt(self, column, value):
+        return self._filter(column, "gt", value)
+
+    def gte(self, column, value):
+        return self._filter(column, "gte", value)
+
+    def lt(self, column, value):
+        return self._filter(column, "lt", value)
+
+    def lte(self, column, value):
+        return self._filter(column, "lte", value)
+
+    def in_(self, column, values):
+        return self._filter(column, "in", list(values))
+
+    def is_(self, column, value):
+        return self._filter(column, "is", value)
+
+    def or_(self, *groups):
+        # Each group is a (column, op, value) tuple or a list of them ANDed together:
+        #   .or_(("created_at", "lt", t), [("created_at", "eq", t), ("id", "lt", i)])
+        groups = [[g] if isinstance(g, tuple) else list(g) for g in groups]
+        return self._filter(None, "or", groups)
+
+    def order(self, column, desc=False):
+        self.orders.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def offset(self, count):
+        self.offset_count = count
+        return self
+
+    async def execute(self):
+        if not metrics.ENABLED:
+            return await self.backend.execute(self)
+        metrics.db_in_flight.inc(self.table)
+        start = time.perf_counter()
+        failed = True
+        try:
+            res = await self.backend.execute(self)
+            failed = False
+            return res
+        finally:
+            metrics.db_in_flight.dec(self.table)
+            metrics.observe_db(self.table, self.method, time.perf_counter() - start, failed)
+
+
+# --- PostgREST (Supabase) backend ---
+
+def _format_value(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _quote_list_item(value):
+    s = _format_value(value)
+    # PostgREST reserves , ( ) and " inside in.(...) lists
+    if any(c in s for c in ',()" '):
+        s = '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return s
+
+
+def _format_condition(column, op, value):
+    if op == "in":
+        return f"{column}.in.(" + ",".join(_quote_list_item(v) for v in value) + ")"
+    if op == "is" or value is None:
+        return f"{column}.is.{_format_value(value)}"
+    return f"{column}.{op}.{_quote_list_item(value)}"
+
+
+def _format_group(group):
+    if len(group) == 1:
+        return _format_condition(*group[0])
+    return "and(" + ",".join(_format_condition(*c) for c in group) + ")"
+
+
+class PostgrestBackend:
+    def __init__(self, base_url, api_key, pool_size=POOL_SIZE, timeout=TIMEOUT, retries=RETRIES):
+        self.base_url = base_url.rstrip("/") + "/rest/v1"
+        self.headers = {
+            "apikey": api_key,
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(timeout)
+        self.retries = retries
+        self.client = None
+
+    def _client(self):
+        # Created lazily so it binds to the running event loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=self.headers,
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        return self.client
+
+    def _build(self, q):
+        params = []
+        prefer = []
+        body = None
+
+        if q.method == "select":
+            http_method = "GET"
+            params.append(("select", q.columns))
+            if q.count:
+                prefer.append(f"count={q.count}")
+        elif q.method in ("insert", "upsert"):
+            http_method = "POST"
+            body = q.payload
+            prefer.append("return=representation")
+            if q.method == "upsert":
+                prefer.append("resolution=ignore-duplicates" if q.ignore_duplicates else "resolution=merge-duplicates")
+                if q.on_conflict:
+                    params.append(("on_conflict", q.on_conflict))
+            # Bulk inserts must share a column set; PostgREST fills the gaps with defaults
+            if isinstance(body, list) and body:
+                columns = sorted({c for row in body for c in row})
+                params.append(("columns", ",".join(columns)))
+        elif q.method == "update":
+            http_method = "PATCH"
+            body = q.payload
+            prefer.append("return=representation")
+        else:
+            http_method = "DELETE"
+            prefer.append("return=representation")
+
+        for column, op, value in q.filters:
+            if op == "or":
+                params.append(("or", "(" + ",".join(_format_group(g) for g in value) + ")"))
+            elif op == "in":
+                params.append((column, "in.(" + ",".join(_quote_list_item(v) for v in value) + ")"))
+            elif op == "is" or value is None:
+                params.append((column, f"is.{_format_value(value)}"))
+            else:
+                params.append((column, f"{op}.{_format_value(value)}"))
+
+        if q.orders:
+            params.append(("order", ",".join(f"{c}.{'desc' if d else 'asc'}" for c, d in q.orders)))
+        if q.limit_count is not None:
+            params.append(("limit", str(q.limit_count)))
+        if q.offset_count is not None:
+            params.append(("offset", str(q.offset_count)))
+
+        headers = {"Prefer": ",".join(prefer)} if prefer else {}
+        return http_method, params, body, headers
+
+    async def execute(self, q):
+        http_method, params, body, headers = self._build(q)
+        # Plain inserts are the only non-idempotent call; never resend them once they reached the server
+        idempotent = q.method != "insert"
+
+        resp = await self._send(http_method, "/" + q.table, params, body, headers, idempotent)
+
+        if resp.status_code >= 400:
+            try:
+                detail = resp.json().get("message") or resp.text
+            except ValueError:
+                detail = resp.text
+            raise DatabaseError(detail, resp.status_code)
+
+        data = resp.json() if resp.content else []
+        count = None
+        content_range = resp.headers.get("content-range")
+        if content_range and "/" in content_range:
+            total = content_range.split("/")[-1]
+            count = int(total) if total.isdigit() else None
+        return Response(data, count)
+
+    async def _send(self, method, path, params, body, headers, idempotent):
+        client = self._client()
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # Exponential backoff with jitter: ~0.1s, 0.2s, 0.4s ...
+                await asyncio.sleep(0.1 * (2 ** (attempt - 1)) * (1 + random.random()))
+            try:
+                resp = await client.request(method, path, params=params, json=body, headers=headers)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                # Request never left the process, safe to retry anything
+                last_error = e
+                continue
+            except httpx.TransportError as e:
+                if not idempotent:
+                    raise DatabaseError(f"{type(e).__name__}: {e}")
+                last_error = e
+                continue
+
+            if resp.status_code in TRANSIENT_STATUS and idempotent and attempt < self.retries:
+                last_error = DatabaseError(resp.text, resp.status_code)
+                continue
+            return resp
+
+        raise DatabaseError(f"Database unavailable after {self.retries + 1} attempts: {last_error}")
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+# --- In-memory backend (local runs, load tests) ---
+
+def _split_columns(columns):
+    # Split on top-level commas only: "a, b, devices(x, y)" -> ["a", "b", "devices(x, y)"]
+    parts, depth, current = [], 0, ""
+    for c in columns:
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        if c == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += c
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def _matches(row, filters):
+    for column, op, value in filters:
+        if op == "or":
+            if not any(_matches(row, group) for group in value):
+                return False
+            continue
+        v = row.get(column)
+        if op == "eq" and v != value:
+            return False
+        if op == "neq" and v == value:
+            return False
+        if op == "is" and v is not value:
+            return False
+        if op == "in" and v not in value:
+            return False
+        if op in ("gt", "gte", "lt", "lte"):
+            if v is None:
+                return False
+            if op == "gt" and not v > value:
+                return False
+            if op == "gte" and not v >= value:
+                return False
+            if op == "lt" and not v < value:
+                return False
+            if op == "lte" and not v <= value:
+                return False
+    return True
+
+
+class MemoryBackend:
+    # Mirrors the Supabase schema closely enough for the routes in routers/
+    PRIMARY_KEYS = {
+        "employees": "employee_code",
+        "devices": "serial_norm",
+        "labels": "label_id",
+        "verification_events": "id",
+    }
+    # (table, embedded table) -> (local column, remote column)
+    FOREIGN_KEYS = {
+        ("labels", "devices"): ("bound_serial_norm", "serial_norm"),
+    }
+    # Secondary unique columns (NULLs allowed, like Postgres)
+    UNIQUE_KEYS = {
+        "verification_events": ["client_event_id"],
+    }
+    # Stand-ins for SQL triggers: table -> [fn(backend, inserted rows)], run once per statement
+    TRIGGERS = {}
+
+    def __init__(self, seed=None, latency=0.0):
+        self.tables = {}
+        self.sequences = {}
+        self.indexes = {}  # (table, column) -> {value: pk}
+        self.latency = latency
+        for table, rows in (seed or {}).items():
+            self._fire(table, self._insert(table, rows))
+
+    def _table(self, name):
+        return self.tables.setdefault(name, {})
+
+    def _pk(self, table):
+        return self.PRIMARY_KEYS.get(table, "id")
+
+    def _candidates(self, q):
+        table = self._table(q.table)
+        pk = self._pk(q.table)
+        # Primary key lookups skip the scan
+        for column, op, value in q.filters:
+            if column == pk and op == "eq":
+                row = table.get(value)
+                return [row] if row is not None else []
+            if column == pk and op == "in":
+                return [table[v] for v in dict.fromkeys(value) if v in table]
+        return list(table.values())
+
+    def _project(self, table, row, columns):
+        if columns.strip() == "*":
+            return dict(row)
+        out = {}
+        for col in _split_columns(columns):
+            if "(" in col:
+                name, inner = col[:-1].split("(", 1)
+                name = name.strip()
+                local, remote = self.FOREIGN_KEYS[(table, name)]
+                if remote == self._pk(name):
+                    other = self._table(name).get(row.get(local))
+                else:
+                    other = next((r for r in self._table(name).values() if r.get(remote) == row.get(local)), None)
+                out[name] = self._project(name, other, inner) if other is not None else None
+            elif col == "*":
+                out.update(row)
+            else:
+                out[col] = row.get(col)
+        return out
+
+    def _prepare(self, table, row):
+        row = dict(row)
+        pk = self._pk(table)
+        if pk == "id" and row.get("id") is None:
+            seq = self.sequences.get(table, 0) + 1
+            self.sequences[table] = seq
+            row["id"] = seq
+        row.setdefault("created_at", datetime.datetime.now(datetime.timezone.utc).isoformat())
+        return row
+
+    def _index(self, table, column):
+        return self.indexes.setdefault((table, column), {})
+
+    def _insert(self, table, rows):
+        store = self._table(table)
+        pk = self._pk(table)
+        out = []
+        for row in rows if isinstance(rows, list) else [rows]:
+            row = self._prepare(table, row)
+            if row[pk] in store:
+                raise DatabaseError(f'duplicate key value violates unique constraint "{table}_pkey"', 409)
+            for column in self.UNIQUE_KEYS.get(table, []):
+                if row.get(column) is not None and row[column] in self._index(table, column):
+                    raise DatabaseError(f'duplicate key value violates unique constraint "{table}_{column}_key"', 409)
+            store[row[pk]] = row
+            for column in self.UNIQUE_KEYS.get(table, []):
+                if row.get(column) is not None:
+                    self._index(table, column)[row[column]] = row[pk]
+            out.append(dict(row))
+        return out
+
+    def _fire(self, table, inserted):
+        if inserted:
+            for trigger in self.TRIGGERS.get(table, ()):
+                trigger(self, inserted)
+        return inserted
+
+    def _upsert(self, table, rows, on_conflict, ignore_duplicates):
+        store = self._table(table)
+        pk = self._pk(table)
+        key = on_conflict or pk
+        out = []
+        inserted = []
+        for row in rows if isinstance(rows, list) else [rows]:
+            existing = None
+            if key == pk:
+                existing = store.get(row.get(pk))
+            elif key in self.UNIQUE_KEYS.get(table, []):
+                existing = store.get(self._index(table, key).get(row.get(key)))
+            else:
+                existing = next((r for r in store.values() if r.get(key) == row.get(key)), None)
+            if existing is not None:
+                if ignore_duplicates:
+                    continue
+                existing.update(row)
+                out.append(dict(existing))
+            else:
+                inserted.extend(self._insert(table, [row]))
+                out.append(inserted[-1])
+        # Insert triggers see only the new rows, like a Postgres transition table
+        self._fire(table, inserted)
+        return out
+
+    async def execute(self, q):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if q.method == "insert":
+            return Response(self._fire(q.table, self._insert(q.table, q.payload)))
+        if q.method == "upsert":
+            return Response(self._upsert(q.table, q.payload, q.on_conflict, q.ignore_duplicates))
+
+        rows = [r for r in self._candidates(q) if _matches(r, q.filters)]
+
+        if q.method == "update":
+            for r in rows:
+                r.update(q.payload)
+            return Response([dict(r) for r in rows])
+        if q.method == "delete":
+            store = self._table(q.table)
+            pk = self._pk(q.table)
+            for r in rows:
+                store.pop(r[pk], None)
+                for column in self.UNIQUE_KEYS.get(q.table, []):
+                    self._index(q.table, column).pop(r.get(column), None)
+            return Response([dict(r) for r in rows])
+
+        # Stable multi-key sort: apply keys from last to first
+        for column, desc in reversed(q.orders):
+            rows.sort(key=lambda r: (r.get(column) is None, r.get(column) if r.get(column) is not None else 0), reverse=desc)
+        count = len(rows) if q.count else None
+        start = q.offset_count or 0
+        end = start + q.limit_count if q.limit_count is not None else None
+        rows = rows[start:end]
+        return Response([self._project(q.table, r, q.columns) for r in rows], count)
+
+    async def close(self):
+        pass
+
+
+class Database:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def table(self, name):
+        return Query(self.backend, name)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_database():
+    backend = (os.environ.get("DB_BACKEND") or "supabase").lower()
+    if backend == "supabase":
+        if url and key:
+            return Database(PostgrestBackend(url, key))
+        print("Warning: SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not found in environment variables. Using in-memory database.")
+    latency = float(os.environ.get("MEMORY_DB_LATENCY_MS", 0)) / 1000
+    return Database(MemoryBackend(latency=latency))
+
+
+db: Database = create_database()
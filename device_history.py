@@ -0,0 +1,338 @@
+import os
+import json
+import heapq
+import asyncio
+from collections import deque
+import cache
+import history
+
+UNKNOWN = "UNKNOWN_OR_URL"  # E.g. URL redirect events don't have expected serial
+
+RING_SIZE = int(os.environ.get("HISTORY_RING_SIZE", 50))
+BACKFILL_EVENTS = int(os.environ.get("HISTORY_BACKFILL_EVENTS", 2000))
+# sync() re-reads this many ids below the newest seen: ids are assigned at insert but
+# become visible at commit, so a concurrent writer's rows can land just below it
+SYNC_OVERLAP = 100
+# Stands in for the id of a log recorded here and not yet seen by sync() in a history cursor:
+# the next raw page then starts at the entry's timestamp, at worst repeating same-instant entries
+UNKNOWN_ID = 2 ** 62
+
+
+def device_header(sn, dev_info):
+    dev_info = dev_info or {}
+    # Fallback if device not found but serial exists (Deleted device?)
+    model = dev_info.get("model", "Unknown Device")
+    if not dev_info and sn != UNKNOWN:
+        model = f"Unknown Device ({sn})"
+    return model, dev_info.get("serial_raw", sn)
+
+
+def log_entry(e, recovered=False):
+    return {
+        "employee_code": e.get("employee_code"),
+        "employee_name": e.get("employee_name") or e.get("actor_name"),
+        "timestamp": e.get("created_at"),
+        "result": e.get("result"),
+        # Internal, stripped on read
+        "id": e.get("id"),
+        "label_id": e.get("label_id"),
+        "client_event_id": e.get("client_event_id"),
+        "recovered": recovered,
+    }
+
+
+def public_entry(entry):
+    return {k: entry[k] for k in ("employee_code", "employee_name", "timestamp", "result")}
+
+
+async def recover_serials(events):
+    # RECOVERY LOGIC: events saved without expected_serial_norm are attributed to whatever
+    # the label is bound to now. Returns {label_id: serial_norm}.
+    missing_serial_labels = {e['label_id'] for e in events if not e.get('expected_serial_norm') and e.get('label_id')}
+    recovered_map = {}
+    if missing_serial_labels:
+        # Note: We look up even if active=False (history)
+        labels = await cache.get_labels(missing_serial_labels)
+        for label_id, l in labels.items():
+            if l:
+                recovered_map[label_id] = l['bound_serial_norm']
+    return recovered_map
+
+
+async def group_events(events):
+    """Groups a page of events (newest first) by device, as /api/history/grouped returns them."""
+    recovered_map = await recover_serials(events)
+
+    serials = set()
+    for e in events:
+        sn = e.get('expected_serial_norm') or recovered_map.get(e.get('label_id'))
+        if sn:
+            serials.add(sn)
+    devices_map = await cache.get_devices(serials) if serials else {}
+
+    grouped = {}
+    for e in events:
+        sn = e.get('expected_serial_norm') or recovered_map.get(e.get('label_id')) or UNKNOWN
+        if sn not in grouped:
+            model, serial_raw = device_header(sn, devices_map.get(sn))
+            grouped[sn] = {
+                "device_serial_norm": sn,
+                "device_model": model,
+                "device_serial_raw": serial_raw,
+                "access_logs": []
+            }
+        grouped[sn]["access_logs"].append(public_entry(log_entry(e)))
+    return list(grouped.values())
+
+
+def _ring(sn, logs):
+    # Newest first, as the rings are kept
+    for l in logs:
+        yield l["timestamp"] or "", sn, l
+
+
+class DeviceHistory:
+    """Per-device recent access logs, maintained incrementally.
+
+    Built once from the latest BACKFILL_EVENTS events (serial recovery runs
+    here, not per read), then updated as verifications are recorded and
+    labels are bound or deleted. Each device keeps a ring of its RING_SIZE
+    newest logs; a page merges the rings newest first and is serialized once
+    per change. Events recorded by other worker processes are picked up by
+    sync(), which polls verification_events for ids past the newest one seen.
+    """
+
+    def __init__(self, ring_size=RING_SIZE, backfill_events=BACKFILL_EVENTS):
+        self.ring_size = ring_size
+        self.backfill_events = backfill_events
+        self.groups = {}  # serial_norm -> {"device_serial_norm", "device_model", "device_serial_raw", "logs": deque}
+        self.loaded = False
+        self.loading = None
+        self.older_cursor = None  # history cursor for events older than the backfill, if any
+        self.backfill_floor = None  # created_at of the oldest backfilled event when older ones exist
+        self.version = 0  # bumped on every change, keys the serialized page
+        self.cached = None  # (version, limit, body, next_cursor)
+        self.pending = []  # events recorded while the backfill is running
+        self.last_id = 0   # newest verification_events id read by the backfill or sync()
+        self.synced = set()  # ids within SYNC_OVERLAP of last_id, already recorded
+
+    def _group(self, sn, dev_info=None):
+        group = self.groups.get(sn)
+        if group is None:
+            model, serial_raw = device_header(sn, dev_info)
+            group = {
+                "device_serial_norm": sn,
+                "device_model": model,
+                "device_serial_raw": serial_raw,
+                "logs": deque(maxlen=self.ring_size),
+            }
+            self.groups[sn] = group
+        return group
+
+    def _add(self, sn, entry):
+        logs = self._group(sn)["logs"]
+        if entry["client_event_id"]:
+            same = next((l for l in logs if l["client_event_id"] == entry["client_event_id"]), None)
+            if same is not None:
+                # Recorded here before it was stored: keep the id for history cursors
+                same["id"] = same["id"] or entry["id"]
+                return
+        self.version += 1
+        ts = entry["timestamp"] or ""
+        if not logs or ts >= (logs[0]["timestamp"] or ""):
+            logs.appendleft(entry)
+            return
+        # Back-dated (offline) event: slot it in by time, dropping the oldest if full
+        if len(logs) == logs.maxlen and ts < (logs[-1]["timestamp"] or ""):
+            return
+        items = list(logs)
+        i = next((i for i, l in enumerate(items) if (l["timestamp"] or "") <= ts), len(items))
+        items.insert(i, entry)
+        logs.clear()
+        logs.extend(items[:logs.maxlen])
+
+    async def load(self):
+        if self.loaded:
+            return
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self._load())
+        try:
+            await asyncio.shield(self.loading)
+        finally:
+            if self.loading is not None and self.loading.done():
+                self.loading = None
+
+    async def _load(self):
+        # Newest id first: events inserted during the backfill are picked up by the next sync
+        res = await history.events_query("id").order("id", desc=True).limit(1).execute()
+        last_id = res.data[0]["id"] if res.data else 0
+        events = []
+        cursor = None
+        while len(events) < self.backfill_events:
+            rows, cursor = await history.fetch_page(min(history.MAX_PAGE_SIZE, self.backfill_events - len(events)), cursor)
+            events.extend(rows)
+            if not cursor:
+                break
+
+        recovered_map = await recover_serials(events)
+        serials = {e.get('expected_serial_norm') or recovered_map.get(e.get('label_id')) for e in events}
+        serials.discard(None)
+        devices_map = await cache.get_devices(serials) if serials else {}
+
+        self.groups = {}
+        self.version += 1
+        self.older_cursor = cursor
+        self.backfill_floor = events[-1]["created_at"] if cursor else None
+        self.last_id = last_id
+        self.synced = {e["id"] for e in events if e["id"] > last_id - SYNC_OVERLAP}
+        # Oldest first so each ring ends up holding its newest entries
+        for e in reversed(events):
+            sn = e.get('expected_serial_norm')
+            recovered = False
+            if not sn and e.get('label_id') in recovered_map:
+                sn = recovered_map[e['label_id']]
+                recovered = True
+            sn = sn or UNKNOWN
+            self._group(sn, devices_map.get(sn))
+            self._add(sn, log_entry(e, recovered))
+
+        self.loaded = True
+        pending, self.pending = self.pending, []
+        for e in pending:
+            await self.record(e)
+
+    async def record(self, event):
+        if not self.loaded:
+            # Replayed after the backfill; bounded in case the database stays down
+            if len(self.pending) < self.backfill_events:
+                self.pending.append(event)
+            return
+        sn = event.get('expected_serial_norm') or UNKNOWN
+        if sn not in self.groups and sn != UNKNOWN:
+            self._group(sn, await cache.get_device(sn))
+        self._add(sn, log_entry(event))
+
+    async def sync(self):
+        # Other workers' events; this worker's own are already in the rings (deduped by client_event_id)
+        if not self.loaded:
+            return
+        after = self.last_id - SYNC_OVERLAP
+        while True:
+            res = await history.events_query().gt("id", after).order("id").limit(history.MAX_PAGE_SIZE).execute()
+            for e in res.data:
+                if e["id"] not in self.synced:
+                    self.synced.add(e["id"])
+                    await self.record(e)
+            if res.data:
+                after = res.data[-1]["id"]
+                self.last_id = max(self.last_id, after)
+            if len(res.data) < history.MAX_PAGE_SIZE:
+                break
+        self.synced = {i for i in self.synced if i > self.last_id - SYNC_OVERLAP}
+
+    async def on_bind(self, bindings):
+        # {label_id: serial_norm}: events saved without a serial for these labels now belong to
+        # the bound devices. One pass over the rings however many labels were bound.
+        if not self.loaded or not bindings:
+            return
+        moved = {}
+        for sn in (UNKNOWN, *[s for s, g in self.groups.items() if any(l["recovered"] for l in g["logs"])]):
+            group = self.groups.get(sn)
+            if group is None:
+                continue
+            keep = []
+            for l in group["logs"]:
+                target = bindings.get(l["label_id"])
+                if target is not None and target != sn and (sn == UNKNOWN or l["recovered"]):
+                    moved.setdefault(target, []).append(l)
+                else:
+                    keep.append(l)
+            if len(keep) != len(group["logs"]):
+                group["logs"].clear()
+                group["logs"].extend(keep)
+        if moved:
+            missing = moved.keys() - self.groups.keys()
+            devices = await cache.get_devices(missing) if missing else {}
+            for serial_norm, logs in moved.items():
+                if serial_norm not in self.groups:
+                    self._group(serial_norm, devices.get(serial_norm))
+                for l in sorted(logs, key=lambda l: l["timestamp"] or ""):
+                    l["recovered"] = True
+                    self._add(serial_norm, l)
+        self.version += 1
+        self._prune()
+
+    def on_delete(self, label_id):
+        # Recovered entries were only attributed through this label; they go back to unknown
+        if not self.loaded:
+            return
+        moved = []
+        for sn, group in self.groups.items():
+            if sn == UNKNOWN:
+                continue
+            gone = [l for l in group["logs"] if l["recovered"] and l["label_id"] == label_id]
+            if gone:
+                moved.extend(gone)
+                keep = [l for l in group["logs"] if not (l["recovered"] and l["label_id"] == label_id)]
+                group["logs"].clear()
+                group["logs"].extend(keep)
+        for l in sorted(moved, key=lambda l: l["timestamp"] or ""):
+            l["recovered"] = False
+            self._add(UNKNOWN, l)
+        self.version += 1
+        self._prune()
+
+    def on_device(self, device):
+        group = self.groups.get(device['serial_norm'])
+        if group is not None:
+            group["device_model"], group["device_serial_raw"] = device_header(device['serial_norm'], device)
+            self.version += 1
+
+    def _prune(self):
+        for sn in [sn for sn, g in self.groups.items() if not g["logs"]]:
+            del self.groups[sn]
+
+    def page(self, limit):
+        """The newest `limit` logs grouped by device, as JSON bytes, and the history cursor for older ones.
+
+        Below the oldest entry of a full ring (older ones were evicted) or of the
+        backfill window, the rings may be missing logs: the page stops there and
+        the cursor hands over to raw pages. Returns None when nothing is above
+        that point, so the caller serves the first raw page instead.
+        """
+        if self.cached and self.cached[:2] == (self.version, limit):
+            return self.cached[2:]
+        floor = self.backfill_floor or ""
+        for g in self.groups.values():
+            if len(g["logs"]) == g["logs"].maxlen:
+                floor = max(floor, g["logs"][-1]["timestamp"] or "")
+        merged = heapq.merge(*(_ring(sn, g["logs"]) for sn, g in self.groups.items()), key=lambda item: item[0], reverse=True)
+        grouped = {}
+        taken = 0
+        last = None
+        more = bool(floor) or bool(self.older_cursor)
+        for ts, sn, l in merged:
+            if taken == limit or (floor and ts <= floor):
+                more = True
+                break
+            group = grouped.get(sn)
+            if group is None:
+                g = self.groups[sn]
+                group = grouped[sn] = {
+                    "device_serial_norm": sn,
+                    "device_model": g["device_model"],
+                    "device_serial_raw": g["device_serial_raw"],
+                    "access_logs": [],
+                }
+            group["access_logs"].append(public_entry(l))
+            taken += 1
+            last = l
+        if last is None and more:
+            return None
+        next_cursor = history.encode_cursor({"created_at": last["timestamp"], "id": last["id"] or UNKNOWN_ID}) if more else None
+        body = json.dumps(list(grouped.values()), separators=(",", ":"), ensure_ascii=False, default=str).encode()
+        self.cached = (self.version, limit, body, next_cursor)
+        return body, next_cursor
+
+
+device_history = DeviceHistory()
@@ -0,0 +1,235 @@
+import csv
+import json
+import codecs
+import datetime
+from database import db
+from utils import normalize_serial
+import cache
+import label_sync
+from device_history import device_history
+from serial_index import serial_index
+from mapping_index import mapping_index
+
+CHUNK_SIZE = 500
+MAX_REPORTED_ERRORS = 1000
+
+
+async def iter_lines(chunks):
+    # Decodes an async byte stream into lines without buffering the whole body
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buf = ""
+    async for chunk in chunks:
+        buf += decoder.decode(chunk)
+        lines = buf.split("\n")
+        buf = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    buf += decoder.decode(b"", final=True)
+    if buf:
+        yield buf.rstrip("\r")
+
+
+async def iter_records(lines, fmt):
+    # Yields (row_number, dict) from CSV (with header) or NDJSON lines
+    header = None
+    row_number = 0
+    async for line in lines:
+        if not line.strip():
+            continue
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [h.strip().lower() for h in values]
+                continue
+            row_number += 1
+            yield row_number, dict(zip(header, values))
+        else:
+            row_number += 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield row_number, record if isinstance(record, dict) else None
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.devices_created = 0
+        self.devices_existing = 0
+        self.labels_bound = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, row, record, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({
+                "row": row,
+                "serial_raw": (record or {}).get("serial_raw"),
+                "label_id": (record or {}).get("label_id"),
+                "error": message,
+            })
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "devices_created": self.devices_created,
+            "devices_existing": self.devices_existing,
+            "labels_bound": self.labels_bound,
+            "error_count": self.error_count,
+            "errors": sorted(self.errors, key=lambda e: e["row"]),
+            "errors_truncated": self.error_count > len(self.errors),
+        }
+
+
+class DeviceImporter:
+    """Bulk device creation and label binding from a streamed CSV/NDJSON upload.
+
+    Rows are processed CHUNK_SIZE at a time: one devices lookup, one labels
+    lookup, then one chunked insert/upsert each, instead of an HTTP round
+    trip per device. Only the chunk and the sets of serials/labels already
+    seen are held in memory.
+    """
+
+    def __init__(self, create_devices=True, rebind=False):
+        self.create_devices = create_devices
+        self.rebind = rebind
+        self.report = ImportReport()
+        self.seen_serials = set()
+        self.seen_labels = set()
+
+    async def run(self, records):
+        chunk = []
+        async for row_number, record in records:
+            self.report.rows += 1
+            parsed = self._parse(row_number, record)
+            if parsed:
+                chunk.append(parsed)
+            if len(chunk) >= CHUNK_SIZE:
+                await self._process(chunk)
+                chunk = []
+        if chunk:
+            await self._process(chunk)
+        return self.report.to_dict()
+
+    def _parse(self, row_number, record):
+        if record is None:
+            self.report.error(row_number, None, "Malformed row")
+            return None
+        serial_raw = str(record.get("serial_raw") or "").strip()
+        if not serial_raw:
+            self.report.error(row_number, record, "Missing serial_raw")
+            return None
+        mfg_date = record.get("mfg_date") or None
+        if mfg_date:
+            try:
+                mfg_date = datetime.date.fromisoformat(str(mfg_date).strip()).isoformat()
+            except ValueError:
+                self.report.error(row_number, record, f"Invalid mfg_date {mfg_date!r}, expected YYYY-MM-DD")
+                return None
+        label_id = str(record.get("label_id") or "").strip() or None
+        return {
+            "row": row_number,
+            "record": record,
+            "serial_raw": serial_raw,
+            "serial_norm": normalize_serial(serial_raw),
+            "model": (str(record.get("model")).strip() or None) if record.get("model") is not None else None,
+            "mfg_date": mfg_date,
+            "label_id": label_id,
+        }
+
+    async def _process(self, chunk):
+        # 1. One lookup for the chunk's devices, one for its labels
+        res = await db.table("devices").select("serial_norm").in_("serial_norm", {r["serial_norm"] for r in chunk}).execute()
+        existing = {d['serial_norm'] for d in res.data}
+        current = {}
+        label_ids = {r["label_id"] for r in chunk if r["label_id"]}
+        if label_ids:
+            res = await db.table("labels").select("label_id, bound_serial_norm, active").in_("label_id", label_ids).execute()
+            current = {l['label_id']: l for l in res.data}
+
+        # 2. Decide every row before writing anything, so a rejected row leaves no device behind
+        new_devices = {}
+        ok_rows = []
+        chunk_labels = set()
+        chunk_serials = set()
+        for r in chunk:
+            sn = r["serial_norm"]
+            if r["label_id"]:
+                if r["label_id"] in self.seen_labels or r["label_id"] in chunk_labels:
+                    self.report.error(r["row"], r["record"], f"Duplicate label_id {r['label_id']} in file")
+                    continue
+                bound = current.get(r["label_id"])
+                if bound and bound.get('active') and bound['bound_serial_norm'] != sn and not self.rebind:
+                    self.report.error(r["row"], r["record"], f"Label {r['label_id']} is already bound to {bound['bound_serial_norm']}")
+                    continue
+            elif sn in self.seen_serials or sn in chunk_serials:
+                self.report.error(r["row"], r["record"], f"Duplicate serial {sn} in file")
+                continue
+
+            if sn in existing or sn in self.seen_serials or sn in chunk_serials:
+                if sn in existing and sn not in self.seen_serials and sn not in chunk_serials:
+                    self.report.devices_existing += 1
+            elif not self.create_devices:
+                self.report.error(r["row"], r["record"], f"Unknown serial {sn}")
+                continue
+            else:
+                new_devices.setdefault(sn, {
+                    "serial_raw": r["serial_raw"],
+                    "serial_norm": sn,
+                    "model": r["model"],
+                    "mfg_date": r["mfg_date"],
+                    "created_at": datetime.datetime.now().isoformat(),
+                })
+            if r["label_id"]:
+                chunk_labels.add(r["label_id"])
+            chunk_serials.add(sn)
+            ok_rows.append(r)
+
+        # 3. Devices: one insert for the new ones
+        if new_devices:
+            try:
+                res = await db.table("devices").upsert(list(new_devices.values()), on_conflict="serial_norm", ignore_duplicates=True).execute()
+            except Exception as e:
+                for r in ok_rows:
+                    if r["serial_norm"] in new_devices:
+                        self.report.error(r["row"], r["record"], f"Device insert failed: {e}")
+                ok_rows = [r for r in ok_rows if r["serial_norm"] not in new_devices]
+            else:
+                self.report.devices_created += len(res.data)
+                for d in res.data:
+                    cache.device_cache.invalidate(d['serial_norm'])
+                    device_history.on_device(d)
+                    serial_index.add(d['serial_norm'])
+                    mapping_index.on_device(d)
+        self.seen_serials.update(r["serial_norm"] for r in ok_rows)
+
+        # 4. Labels: one upsert for those not already bound as requested
+        bindings = []
+        for r in ok_rows:
+            if not r["label_id"]:
+                continue
+            bound = current.get(r["label_id"])
+            if bound and bound.get('active') and bound['bound_serial_norm'] == r["serial_norm"]:
+                self.seen_labels.add(r["label_id"])
+            else:
+                bindings.append(r)
+        if not bindings:
+            return
+        try:
+            await db.table("labels").upsert([
+                {"label_id": r["label_id"], "bound_serial_norm": r["serial_norm"], "active": True}
+                for r in bindings
+            ]).execute()
+        except Exception as e:
+            for r in bindings:
+                self.report.error(r["row"], r["record"], f"Label bind failed: {e}")
+            return
+
+        self.seen_labels.update(r["label_id"] for r in bindings)
+        self.report.labels_bound += len(bindings)
+        await label_sync.record_changes([(r["label_id"], r["serial_norm"]) for r in bindings])
+        for r in bindings:
+            cache.label_cache.invalidate(r["label_id"])
+        await device_history.on_bind({r["label_id"]: r["serial_norm"] for r in bindings})
@@ -0,0 +1,98 @@
+import io
+import csv
+import json
+import base64
+from database import db
+
+# fetch_page asks for one row more than the page to detect a next page; PostgREST caps
+# responses at max_rows (1000 on Supabase), so limit + 1 has to stay within it
+MAX_PAGE_SIZE = 999
+EXPORT_PAGE_SIZE = 999
+
+EXPORT_COLUMNS = [
+    "id", "created_at", "employee_code", "employee_name", "label_id",
+    "expected_serial_norm", "observed_serial_raw", "observed_serial_norm",
+    "method", "result", "notes", "is_offline_event",
+]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    raw = json.dumps([row['created_at'], row['id']], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, event_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return created_at, event_id
+    except Exception:
+        raise InvalidCursor("Invalid cursor")
+
+
+def events_query(columns="*", employee_code=None, label_id=None, result=None, since=None, until=None):
+    q = db.table("verification_events").select(columns)
+    if employee_code:
+        q = q.eq("employee_code", employee_code)
+    if label_id:
+        q = q.eq("label_id", label_id)
+    if result:
+        q = q.eq("result", result)
+    if since:
+        q = q.gte("created_at", since.isoformat())
+    if until:
+        q = q.lt("created_at", until.isoformat())
+    return q
+
+
+async def fetch_page(limit, cursor=None, **filters):
+    """Newest-first page of verification_events, keyset-paginated on (created_at, id).
+
+    Returns (rows, next_cursor); next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    q = events_query(**filters)
+    if cursor:
+        created_at, event_id = decode_cursor(cursor)
+        # Strictly after the cursor row in (created_at desc, id desc) order
+        q = q.or_(("created_at", "lt", created_at), [("created_at", "eq", created_at), ("id", "lt", event_id)])
+    # One extra row tells us whether there's a next page without a count query
+    res = await q.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    rows = res.data
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1])
+    return rows, next_cursor
+
+
+async def iter_pages(cursor=None, **filters):
+    # Walks the whole filtered table one page at a time; memory stays at one page
+    while True:
+        rows, cursor = await fetch_page(EXPORT_PAGE_SIZE, cursor, **filters)
+        if rows:
+            yield rows
+        if not cursor:
+            return
+
+
+async def export_ndjson(**filters):
+    async for rows in iter_pages(**filters):
+        yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+
+async def export_csv(**filters):
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    async for rows in iter_pages(**filters):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
@@ -0,0 +1,87 @@
+import os
+from database import db
+
+# Beyond this many changes a full snapshot is smaller than the delta
+MAX_DELTA_CHANGES = int(os.environ.get("LABEL_SYNC_MAX_DELTA", 5000))
+# Rows per request; PostgREST caps responses at max_rows (1000 on Supabase)
+PAGE_SIZE = 1000
+# Called with each recorded batch of changes, e.g. to update this worker's label table
+listeners = []
+
+
+async def record_changes(changes):
+    # changes: [(label_id, bound_serial_norm or None)]; None marks a deleted mapping
+    rows = [
+        {"label_id": label_id, "bound_serial_norm": serial_norm, "deleted": serial_norm is None}
+        for label_id, serial_norm in changes
+    ]
+    if rows:
+        await db.table("label_changes").insert(rows).execute()
+        for listener in listeners:
+            listener(changes)
+
+
+async def current_version():
+    res = await db.table("label_changes").select("id").order("id", desc=True).limit(1).execute()
+    return res.data[0]['id'] if res.data else 0
+
+
+async def fetch_active():
+    # Keyset walk over active labels: a single select would be cut off at the server's row cap
+    pairs = []
+    last = None
+    while True:
+        q = db.table("labels").select("label_id, bound_serial_norm").eq("active", True).order("label_id").limit(PAGE_SIZE)
+        if last is not None:
+            q = q.gt("label_id", last)
+        res = await q.execute()
+        pairs.extend((r['label_id'], r['bound_serial_norm']) for r in res.data)
+        if len(res.data) < PAGE_SIZE:
+            return pairs
+        last = res.data[-1]['label_id']
+
+
+async def snapshot():
+    return {
+        "full": True,
+        "labels": [[label_id, serial_norm] for label_id, serial_norm in await fetch_active()],
+        "deleted": [],
+    }
+
+
+async def delta(since):
+    # Returns None when the client is too far behind and should take a snapshot
+    rows = []
+    last = since
+    while True:
+        res = await db.table("label_changes").select("id, label_id, bound_serial_norm, deleted").gt("id", last).order("id").limit(PAGE_SIZE).execute()
+        rows.extend(res.data)
+        if len(rows) > MAX_DELTA_CHANGES:
+            return None
+        if len(res.data) < PAGE_SIZE:
+            break
+        last = res.data[-1]['id']
+
+    # Last change per label wins
+    latest = {}
+    for r in rows:
+        latest[r['label_id']] = r
+    return {
+        "full": False,
+        "labels": [[r['label_id'], r['bound_serial_norm']] for r in latest.values() if not r['deleted']],
+        "deleted": [r['label_id'] for r in latest.values() if r['deleted']],
+    }
+
+
+async def changes_since(since, version):
+    # Callers read `version` first: a change landing mid-read is simply sent again next time
+    feed = None
+    if since:
+        if since == version:
+            feed = {"full": False, "labels": [], "deleted": []}
+        elif since < version:
+            feed = await delta(since)
+    if feed is None:
+        feed = await snapshot()
+    feed["version"] = version
+    return feed
@@ -0,0 +1,256 @@
+import os
+import mmap
+import struct
+import asyncio
+import label_sync
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process build lock, rebuilds may overlap
+    fcntl = None
+
+PATH = os.environ.get("LABEL_TABLE_PATH", os.path.join(os.path.dirname(__file__), "data", "label_table.bin"))
+REFRESH_INTERVAL = float(os.environ.get("LABEL_TABLE_REFRESH", 5))
+# Past this many changes since the snapshot, rebuild it instead of growing the overlay
+MAX_OVERLAY = int(os.environ.get("LABEL_TABLE_MAX_OVERLAY", 20000))
+
+MAGIC = b"LBT1"
+HEADER = struct.Struct("<4sIQ")  # magic, entry count, label_changes version
+ENTRY = struct.Struct("<IIHH")   # label offset, serial offset, label length, serial length
+
+
+async def fetch_active():
+    return [(label_id, serial_norm) for label_id, serial_norm in await label_sync.fetch_active() if serial_norm]
+
+
+def write_table(path, pairs, version):
+    """Writes the sorted binary table next to `path` and renames it into place.
+
+    Processes that still map the previous file keep reading it until they reopen.
+    """
+    encoded = sorted((label.encode(), serial.encode()) for label, serial in pairs)
+    # Serials repeat when several labels point at one device; store each once
+    serial_offsets = {}
+    blob = bytearray()
+    entries = bytearray()
+    for label, serial in encoded:
+        label_off = len(blob)
+        blob += label
+        serial_off = serial_offsets.get(serial)
+        if serial_off is None:
+            serial_off = serial_offsets[serial] = len(blob)
+            blob += serial
+        entries += ENTRY.pack(label_off, serial_off, len(label), len(serial))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(encoded), version))
+        f.write(entries)
+        f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(encoded)
+
+
+async def build(path=PATH):
+    # Version first: a change landing during the walk is replayed from the overlay
+    version = await label_sync.current_version()
+    pairs = await fetch_active()
+    return write_table(path, pairs, version), version
+
+
+def read_version(path=PATH):
+    try:
+        with open(path, "rb") as f:
+            magic, _, version = HEADER.unpack(f.read(HEADER.size))
+        return version if magic == MAGIC else None
+    except (OSError, struct.error):
+        return None
+
+
+class MappedTable:
+    """Read-only view of a table file. Lookups binary-search the mapped pages."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic, self.count, self.version = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError(f"{path} is not a label table")
+        self.blob_start = HEADER.size + self.count * ENTRY.size
+        if len(self.mm) < self.blob_start:
+            self.mm.close()
+            raise ValueError(f"{path} is truncated")
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self.mm, HEADER.size + i * ENTRY.size)
+
+    def get(self, label_id):
+        key = label_id.encode()
+        mm, start = self.mm, self.blob_start
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            label_off, serial_off, label_len, serial_len = self._entry(mid)
+            label = mm[start + label_off:start + label_off + label_len]
+            if label < key:
+                lo = mid + 1
+            elif label > key:
+                hi = mid
+            else:
+                return mm[start + serial_off:start + serial_off + serial_len].decode()
+        return None
+
+    def close(self):
+        self.mm.close()
+
+
+class LabelTable:
+    """Active label -> bound serial, shared by all workers through one mmap'd file.
+
+    The file is a snapshot at a label_changes version. Each worker keeps a
+    small overlay of changes made since (its own writes immediately, other
+    workers' on the next refresh), and rebuilds the snapshot once the overlay
+    grows past MAX_OVERLAY. A snapshot left by a previous run is reused and
+    caught up from label_changes. Not ready until a snapshot is mapped; callers
+    fall back to the label cache meanwhile.
+    """
+
+    def __init__(self, path=PATH, refresh_interval=REFRESH_INTERVAL, max_overlay=MAX_OVERLAY):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.max_overlay = max_overlay
+        self.table = None
+        self.overlay = {}  # label_id -> bound serial, or None once unbound
+        self.seen = 0      # label_changes version reflected by table + overlay
+        self.task = None
+        self.lookups = 0
+        self.rebuilds = 0
+        label_sync.listeners.append(self.apply)
+
+    @property
+    def ready(self):
+        return self.table is not None
+
+    def bound_serial(self, label_id):
+        self.lookups += 1
+        if label_id in self.overlay:
+            return self.overlay[label_id]
+        return self.table.get(label_id)
+
+    def apply(self, changes):
+        # [(label_id, serial or None)], as passed to label_sync.record_changes
+        if self.table is not None:
+            for label_id, serial_norm in changes:
+                self.overlay[label_id] = serial_norm
+
+    def _map(self, table):
+        old, self.table = self.table, table
+        self.overlay = {}
+        self.seen = table.version
+        if old is not None:
+            old.close()
+
+    def map(self):
+        self._map(MappedTable(self.path))
+
+    async def load(self):
+        # Reuse the snapshot on disk (the launcher's, or the previous run's) and catch up from
+        # label_changes; refresh() rebuilds only when the delta is unavailable or too large
+        if self.table is None and read_version(self.path) is not None:
+            try:
+                self.map()
+            except (OSError, ValueError) as e:
+                print(f"Label table {self.path} unreadable, rebuilding: {e}")
+        if self.table is None:
+            if not await self._build() and read_version(self.path) is None:
+                return  # Another process is writing the first snapshot; the refresh loop retries
+            self.map()
+        await self.refresh()
+
+    async def _build(self):
+        lock = None
+        if fcntl is not None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            lock = open(self.path + ".lock", "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another worker is rebuilding; pick its file up on the next refresh
+                lock.close()
+                return False
+        try:
+            await build(self.path)
+            self.rebuilds += 1
+            return True
+        finally:
+            if lock is not None:
+                lock.close()
+
+    async def refresh(self):
+        if self.table is None:
+            return
+        # A newer snapshot written by another process
+        try:
+            if os.stat(self.path).st_ino != self.table.inode and (read_version(self.path) or 0) > self.seen:
+                self.map()
+        except OSError:
+            pass
+
+        version = await label_sync.current_version()
+        if version == self.seen:
+            return
+        # Behind by more than the overlay should hold, or a snapshot from another database
+        feed = await label_sync.delta(self.seen) if version > self.seen else None
+        if feed is None or len(self.overlay) + len(feed["labels"]) + len(feed["deleted"]) > self.max_overlay:
+            if await self._build():
+                self.map()
+                await self.refresh()
+            return
+        for label_id, serial_norm in feed["labels"]:
+            self.overlay[label_id] = serial_norm
+        for label_id in feed["deleted"]:
+            self.overlay[label_id] = None
+        self.seen = version
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                if self.table is None:
+                    await self.load()
+                else:
+                    await self.refresh()
+            except Exception as e:
+                print(f"Label table refresh failed: {e}")
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "entries": self.table.count if self.table else 0,
+            "version": self.seen,
+            "overlay": len(self.overlay),
+            "lookups": self.lookups,
+            "rebuilds": self.rebuilds,
+            "path": self.path,
+        }
+
+
+label_table = LabelTable()
@@ -1,23 +1,128 @@
 from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from routers import api, pages
+from database import db
+import audit
+from device_history import device_history
+from serial_index import serial_index
+from label_table import label_table
+import photos
+import static_assets
+import metrics
+import cache
 import os
+import asyncio
+
+WARMUP_RETRY_INTERVAL = 5
+# How often each worker picks up devices and verification events recorded by the others
+SHARED_STATE_REFRESH = float(os.environ.get("SHARED_STATE_REFRESH", 5))
 
 app = FastAPI(title="Hospital Equipment Verification")
+# Set by the production launcher (serve.py) once shutdown starts, so /ready fails first
+app.state.draining = False
+app.state.warmup = None
+app.state.follower = None
+app.add_middleware(GZipMiddleware, minimum_size=1000)
+# Outermost, so request timings include compression
+app.add_middleware(metrics.MetricsMiddleware)
 
 # Mount Static Files
 static_dir = os.path.join(os.path.dirname(__file__), 'static')
 if not os.path.exists(static_dir):
     os.makedirs(static_dir)
 
-app.mount("/static", StaticFiles(directory=static_dir), name="static")
+# Serves the precompressed, content-hashed build from scripts/build_assets.py when present
+app.mount("/static", static_assets.assets, name="static")
 
 # Include Routers
 app.include_router(api.router)
 app.include_router(pages.router)
 
+def collect_app_metrics():
+    stats = audit.writer.stats()
+    metrics.audit_queue_depth.set(value=stats["queue_depth"])
+    for outcome in ("submitted", "written", "spilled", "dropped", "replayed"):
+        metrics.audit_events.set(outcome, value=stats[outcome])
+    for c in cache.stats():
+        metrics.cache_entries.set(c["name"], value=c["size"])
+        for result in ("hits", "misses", "coalesced", "evictions"):
+            metrics.cache_lookups.set(c["name"], result, value=c[result])
+
+metrics.registry.collectors.append(collect_app_metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+# (name, is_loaded, load) for everything /ready waits on
+WARMUP = [
+    ("label_table", lambda: label_table.ready, label_table.load),
+    ("device_history", lambda: device_history.loaded, device_history.load),
+    ("serial_index", lambda: serial_index.loaded, serial_index.load),
+]
+
+async def warm_caches():
+    for name, is_loaded, load in WARMUP:
+        if not is_loaded():
+            try:
+                await load()
+            except Exception as e:
+                print(f"Warmup of {name} failed: {e}")
+    return all(is_loaded() for _, is_loaded, _ in WARMUP)
+
+async def keep_warming():
+    # The database was down at startup: keep retrying, /ready stays 503 until done
+    while not await warm_caches():
+        await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+
+async def follow_other_workers():
+    # Each serve.py worker holds its own history and serial index; both poll for the others' writes
+    while True:
+        await asyncio.sleep(SHARED_STATE_REFRESH)
+        for name, sync in (("device_history", device_history.sync), ("serial_index", serial_index.sync)):
+            try:
+                await sync()
+            except Exception as e:
+                print(f"Refresh of {name} failed: {e}")
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    checks = {name: is_loaded() for name, is_loaded, _ in WARMUP}
+    checks["accepting"] = not app.state.draining
+    return JSONResponse(checks, status_code=200 if all(checks.values()) else 503)
+
+@app.on_event("startup")
+async def startup():
+    # Replays any audit journal left by a previous run, then starts the flusher
+    await audit.writer.start()
+    photos.thumbnails.start()
+    metrics.loop_monitor.start()
+    metrics.registry.start()
+    # Label table (shared snapshot), per-device history and serial index
+    if not await warm_caches():
+        app.state.warmup = asyncio.create_task(keep_warming())
+    label_table.start()
+    app.state.follower = asyncio.create_task(follow_other_workers())
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.warmup is not None:
+        app.state.warmup.cancel()
+    if app.state.follower is not None:
+        app.state.follower.cancel()
+    await label_table.stop()
+    # Flush pending audit rows before releasing pooled database connections
+    await audit.writer.stop()
+    await photos.thumbnails.stop()
+    await metrics.loop_monitor.stop()
+    await metrics.registry.stop()
+    await photos.store.close()
+    await db.close()
+
 if __name__ == "__main__":
     import uvicorn
+    # Development server; production runs `python serve.py` (multiple workers, preloaded app)
     # Use 0.0.0.0 for proper networking, port from env or 8000
     port = int(os.environ.get("PORT", 8000))
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
@@ -0,0 +1,242 @@
+import asyncio
+import bisect
+from collections import defaultdict
+from database import db
+import cache
+import label_sync
+
+PAGE_SIZE = 1000
+GRAM = 3
+SORT_FIELDS = ("label_id", "serial", "model")
+MAX_LIMIT = 200
+
+
+def _keys(row):
+    dev = row["devices"] or {}
+    return {
+        "label_id": row["label_id"].lower(),
+        "serial": (row["bound_serial_norm"] or "").lower(),
+        "model": (dev.get("model") or "").lower(),
+    }
+
+
+def _grams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+def _device(d):
+    if not d:
+        return None
+    return {"serial_raw": d.get("serial_raw"), "model": d.get("model"), "status": d.get("status")}
+
+
+class MappingIndex:
+    """Active label -> device mappings for the admin console, searchable and paged in memory.
+
+    Each field is kept as a sorted (key, label_id) list, so an unfiltered page
+    or a prefix match is a bisect and a slice, and substring matches go through
+    trigram postings before the exact check. Label changes arrive through
+    label_sync (this worker's writes immediately, other workers' before the
+    next search); device details are resolved when a label is bound.
+    """
+
+    def __init__(self):
+        self._reset()
+        self.seen = 0                           # label_changes version reflected here
+        self.loaded = False
+        self.loading = None
+        label_sync.listeners.append(self.apply)
+
+    def _reset(self):
+        self.rows = {}                          # label_id -> row as returned by the API
+        self.keys = {}                          # label_id -> lowercased field values
+        self.sorted = {f: [] for f in SORT_FIELDS}
+        self.by_gram = defaultdict(set)
+        self.by_serial = defaultdict(set)
+        self.unresolved = {}                    # label_id -> serial awaiting device details
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _index(self, row):
+        # Everything but the sorted lists
+        label_id = row["label_id"]
+        keys = _keys(row)
+        self.rows[label_id] = row
+        self.keys[label_id] = keys
+        for key in keys.values():
+            for g in _grams(key):
+                self.by_gram[g].add(label_id)
+        self.by_serial[row["bound_serial_norm"]].add(label_id)
+        return keys
+
+    def _add(self, row):
+        label_id = row["label_id"]
+        self._remove(label_id)
+        for field, key in self._index(row).items():
+            bisect.insort(self.sorted[field], (key, label_id))
+
+    def _remove(self, label_id):
+        row = self.rows.pop(label_id, None)
+        if row is None:
+            return
+        keys = self.keys.pop(label_id)
+        for field, key in keys.items():
+            entries = self.sorted[field]
+            i = bisect.bisect_left(entries, (key, label_id))
+            if i < len(entries) and entries[i] == (key, label_id):
+                del entries[i]
+            for g in _grams(key):
+                self.by_gram[g].discard(label_id)
+        labels = self.by_serial.get(row["bound_serial_norm"])
+        if labels is not None:
+            labels.discard(label_id)
+            if not labels:
+                del self.by_serial[row["bound_serial_norm"]]
+
+    def apply(self, changes):
+        # [(label_id, serial or None)], as passed to label_sync.record_changes
+        if not self.loaded:
+            return
+        for label_id, serial_norm in changes:
+            self.unresolved.pop(label_id, None)
+            if serial_norm is None:
+                self._remove(label_id)
+            else:
+                self.unresolved[label_id] = serial_norm
+
+    def on_device(self, device):
+        # A device (re)created under a serial that labels already point at
+        for label_id in list(self.by_serial.get(device['serial_norm'], ())):
+            row = dict(self.rows[label_id], devices=_device(device))
+            self._add(row)
+
+    async def load(self):
+        if self.loaded:
+            return
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self._load())
+        try:
+            await asyncio.shield(self.loading)
+        finally:
+            if self.loading is not None and self.loading.done():
+                self.loading = None
+
+    async def _load(self):
+        # Version first: a change landing during the walk is replayed on the next sync
+        version = await label_sync.current_version()
+        rows = []
+        last = None
+        while True:
+            q = db.table("labels").select("label_id, active, bound_serial_norm, devices(serial_raw, model, status)").eq("active", True).order("label_id").limit(PAGE_SIZE)
+            if last is not None:
+                q = q.gt("label_id", last)
+            res = await q.execute()
+            rows.extend(res.data)
+            if len(res.data) < PAGE_SIZE:
+                break
+            last = res.data[-1]['label_id']
+
+        self._reset()
+        for row in rows:
+            if row['bound_serial_norm']:
+                self._index(row)
+        # One sort per field rather than an insort per row
+        for field in SORT_FIELDS:
+            self.sorted[field] = sorted((keys[field], label_id) for label_id, keys in self.keys.items())
+        self.seen = version
+        self.loaded = True
+
+    async def sync(self):
+        await self.load()
+        version = await label_sync.current_version()
+        if version != self.seen:
+            feed = await label_sync.delta(self.seen) if version > self.seen else None
+            if feed is None:
+                # Too far behind (or the change log was reset): rebuild
+                self.loaded = False
+                await self.load()
+            else:
+                for label_id, serial_norm in feed["labels"]:
+                    self.unresolved[label_id] = serial_norm
+                for label_id in feed["deleted"]:
+                    self.unresolved.pop(label_id, None)
+                    self._remove(label_id)
+                self.seen = version
+
+        if self.unresolved:
+            pending = dict(self.unresolved)
+            devices = await cache.get_devices(set(pending.values()))
+            for label_id, serial_norm in pending.items():
+                # Deleted or rebound while the devices were loading: leave it to that change
+                if self.unresolved.get(label_id) != serial_norm:
+                    continue
+                del self.unresolved[label_id]
+                self._add({
+                    "label_id": label_id,
+                    "active": True,
+                    "bound_serial_norm": serial_norm,
+                    "devices": _device(devices.get(serial_norm)),
+                })
+
+    def _prefix(self, field, q):
+        entries = self.sorted[field]
+        i = bisect.bisect_left(entries, (q, ""))
+        out = set()
+        while i < len(entries) and entries[i][0].startswith(q):
+            out.add(entries[i][1])
+            i += 1
+        return out
+
+    def _contains(self, fields, q):
+        if len(q) >= GRAM:
+            postings = sorted((self.by_gram.get(g, set()) for g in _grams(q)), key=len)
+            candidates = set(postings[0]).intersection(*postings[1:])
+        else:
+            candidates = self.rows.keys()
+        return {
+            label_id for label_id in candidates
+            if any(q in self.keys[label_id][f] for f in fields)
+        }
+
+    def _order(self, matches, sort, desc):
+        if len(matches) * 8 > len(self.rows):
+            # Most rows match: walking the presorted list beats sorting the matches
+            ordered = [label_id for _, label_id in self.sorted[sort] if label_id in matches]
+        else:
+            ordered = sorted(matches, key=lambda label_id: (self.keys[label_id][sort], label_id))
+        return ordered[::-1] if desc else ordered
+
+    async def search(self, q=None, field=None, match="contains", sort="label_id", desc=False, offset=0, limit=50):
+        """One page of mappings matching `q` (case-insensitive) in `field`, or any field when None."""
+        await self.sync()
+        q = (q or "").strip().lower()
+        fields = (field,) if field else SORT_FIELDS
+        matches = None
+        if q:
+            if match == "prefix":
+                matches = set().union(*(self._prefix(f, q) for f in fields))
+            else:
+                matches = self._contains(fields, q)
+
+        total = len(self.rows) if matches is None else len(matches)
+        if matches is None:
+            # Unfiltered: slice the sorted list directly
+            entries = self.sorted[sort]
+            if desc:
+                start = max(0, len(entries) - offset - limit)
+                entries = entries[start:max(0, len(entries) - offset)][::-1]
+            else:
+                entries = entries[offset:offset + limit]
+            page = [label_id for _, label_id in entries]
+        else:
+            page = self._order(matches, sort, desc)[offset:offset + limit]
+        return {
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "items": [self.rows[label_id] for label_id in page],
+        }
+
+
+mapping_index = MappingIndex()
@@ -0,0 +1,381 @@
+import os
+import copy
+import json
+import time
+import asyncio
+import bisect
+import operator
+import contextvars
+
+ENABLED = os.environ.get("METRICS_ENABLED", "1").lower() not in ("0", "false", "no")
+# Requests slower than this are logged with a breakdown; 0 disables the log
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+LOOP_LAG_INTERVAL = 0.5
+# serve.py workers each write their samples here; /metrics merges them so a scrape covers every worker
+SHARED_DIR = os.environ.get("METRICS_DIR", os.path.join(os.path.dirname(__file__), "data", "metrics"))
+SHARE_INTERVAL = 5
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, *labels, value):
+        # Also used to mirror totals kept elsewhere (cache and audit stats) at scrape time
+        self.values[labels] = value
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+    def dump(self):
+        return [[list(labels), value] for labels, value in self.values.items()]
+
+    def merge(self, dumped, combine=operator.add):
+        for labels, value in dumped:
+            labels = tuple(labels)
+            self.values[labels] = combine(self.values[labels], value) if labels in self.values else value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), combine=operator.add):
+        super().__init__(name, help, labelnames)
+        self.combine = combine  # how values from several workers fold into one
+
+    def merge(self, dumped, combine=None):
+        super().merge(dumped, self.combine)
+
+    def dec(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [per-bucket counts (+Inf last), sum]
+
+    def observe(self, *labels, value):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = _format_labels(self.labelnames + ("le",), labels + (_format_number(bound),))
+                yield self.name + "_bucket", le, cumulative
+            base = _format_labels(self.labelnames, labels)
+            yield self.name + "_sum", base, total
+            yield self.name + "_count", base, cumulative
+
+    def dump(self):
+        return [[list(labels), counts, total] for labels, (counts, total) in self.values.items()]
+
+    def merge(self, dumped):
+        for labels, counts, total in dumped:
+            entry = self.values.get(tuple(labels))
+            if entry is None:
+                self.values[tuple(labels)] = [list(counts), total]
+            else:
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Registry:
+    """Metrics of this process, or of every serve.py worker once shared_dir is set.
+
+    Shared, each worker writes its samples to shared_dir/<pid>.json every
+    SHARE_INTERVAL seconds and whichever worker is scraped adds them up.
+    Counters and histograms of exited workers keep counting towards the
+    totals (so they never go backwards); their gauges are left out.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []  # callables run at scrape time to refresh gauges
+        self.shared_dir = None
+        self.task = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+
+    def dump(self):
+        return {m.name: m.dump() for m in self.metrics}
+
+    def write_shared(self, dumped):
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(dumped, f)
+        os.replace(path + ".tmp", path)
+
+    def merged(self):
+        own = os.getpid()
+        workers = []
+        try:
+            names = os.listdir(self.shared_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            pid = name[:-len(".json")]
+            if not name.endswith(".json") or not pid.isdigit() or int(pid) == own:
+                continue
+            try:
+                with open(os.path.join(self.shared_dir, name)) as f:
+                    workers.append((_alive(int(pid)), json.load(f)))
+            except (OSError, ValueError):
+                continue  # Replaced or removed while listing
+        out = []
+        for m in self.metrics:
+            total = copy.copy(m)
+            total.values = {}
+            total.merge(m.dump())
+            for alive, dumped in workers:
+                if m.name in dumped and (alive or m.kind != "gauge"):
+                    total.merge(dumped[m.name])
+            out.append(total)
+        return out
+
+    def start(self):
+        if ENABLED and self.shared_dir and self.task is None:
+            self.task = asyncio.create_task(self._share())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+            # Final totals, so this worker's counters survive it
+            self.collect()
+            self.write_shared(self.dump())
+
+    async def _share(self):
+        while True:
+            await asyncio.sleep(SHARE_INTERVAL)
+            try:
+                self.collect()
+                await asyncio.to_thread(self.write_shared, self.dump())
+            except Exception as e:
+                print(f"Metrics snapshot failed: {e}")
+
+    def render(self):
+        self.collect()
+        metrics = self.merged() if self.shared_dir else self.metrics
+        lines = []
+        for m in metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                lines.append(f"{name}{labels} {_format_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status")))
+http_duration = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route")))
+http_in_flight = registry.register(Gauge("http_requests_in_flight", "HTTP requests being handled", ("method",)))
+http_errors = registry.register(Counter("http_request_errors_total", "Requests that raised or returned 5xx", ("method", "route")))
+
+db_duration = registry.register(Histogram("db_query_duration_seconds", "Database call latency, retries included", ("table", "operation")))
+db_in_flight = registry.register(Gauge("db_queries_in_flight", "Database calls awaiting a response", ("table",)))
+db_errors = registry.register(Counter("db_query_errors_total", "Database calls that failed", ("table", "operation")))
+
+sync_batch_size = registry.register(Histogram("offline_sync_batch_events", "Events per /api/verify/batch request", (), BATCH_BUCKETS))
+sync_events = registry.register(Counter("offline_sync_events_total", "Offline-sync events by outcome", ("status",)))
+
+audit_queue_depth = registry.register(Gauge("audit_queue_depth", "Verification events waiting for the audit writer"))
+audit_events = registry.register(Counter("audit_events_total", "Audit writer events by outcome", ("outcome",)))
+cache_entries = registry.register(Gauge("cache_entries", "Entries held per cache", ("cache",)))
+cache_lookups = registry.register(Counter("cache_lookups_total", "Cache lookups by result", ("cache", "result")))
+
+loop_lag = registry.register(Gauge("event_loop_lag_seconds", "Delay of the latest event loop tick past its schedule", combine=max))
+loop_lag_max = registry.register(Gauge("event_loop_lag_max_seconds", "Worst event loop lag since the previous scrape", combine=max))
+
+
+class RequestTrace:
+    """Per-request timing breakdown, filled in by data-access calls made while handling it."""
+
+    __slots__ = ("db_seconds", "db_calls", "parts")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.db_calls = 0
+        self.parts = {}  # "table.operation" -> [calls, seconds]
+
+    def add(self, key, seconds):
+        self.db_seconds += seconds
+        self.db_calls += 1
+        part = self.parts.get(key)
+        if part is None:
+            self.parts[key] = [1, seconds]
+        else:
+            part[0] += 1
+            part[1] += seconds
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def observe_db(table, operation, seconds, failed=False):
+    db_duration.observe(table, operation, value=seconds)
+    if failed:
+        db_errors.inc(table, operation)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(f"{table}.{operation}", seconds)
+
+
+def log_slow_request(method, path, status, seconds, trace):
+    parts = ", ".join(
+        f"{key} x{calls} {secs * 1000:.1f}ms"
+        for key, (calls, secs) in sorted(trace.parts.items(), key=lambda kv: -kv[1][1])
+    )
+    other = max(0.0, seconds - trace.db_seconds)
+    print(
+        f"Slow request: {method} {path} -> {status} in {seconds * 1000:.1f}ms "
+        f"(db {trace.db_seconds * 1000:.1f}ms over {trace.db_calls} calls, "
+        f"app/serialization/loop {other * 1000:.1f}ms){': ' + parts if parts else ''}"
+    )
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and tracks in-flight counts.
+
+    Pure ASGI so it adds a couple of perf_counter calls per request rather
+    than the task hop of BaseHTTPMiddleware. Routes are labelled by their
+    template (/api/labels/{label_id}) to keep series bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status = 500
+        trace = RequestTrace()
+        token = current_trace.set(trace)
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            http_in_flight.dec(method)
+            current_trace.reset(token)
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_requests.inc(method, route, str(status))
+            http_duration.observe(method, route, value=elapsed)
+            if status >= 500:
+                http_errors.inc(method, route)
+            if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+                log_slow_request(method, scope["path"], status, elapsed, trace)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a sleeping task; CPU-bound handlers show up here."""
+
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.task = None
+        self.worst = 0.0
+
+    def start(self):
+        if ENABLED and self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            loop_lag.set(value=lag)
+            self.worst = max(self.worst, lag)
+
+    def collect(self):
+        loop_lag_max.set(value=self.worst)
+        self.worst = 0.0
+
+
+loop_monitor = LoopLagMonitor()
+registry.collectors.append(loop_monitor.collect)
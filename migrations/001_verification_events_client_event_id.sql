@@ -0,0 +1,7 @@
+-- Idempotency key for offline-queued events replayed through /api/verify/batch.
+-- Holds the client-side UUID from the IndexedDB queue; NULL for online scans.
+alter table verification_events
+    add column if not exists client_event_id text;
+
+create unique index if not exists verification_events_client_event_id_key
+    on verification_events (client_event_id);
@@ -0,0 +1,10 @@
+-- Change log behind /api/labels/sync. The id doubles as the monotonic
+-- version offline clients pass back as ?since=. Rows with deleted = true
+-- are tombstones for mappings removed through DELETE /api/admin/mappings.
+create table if not exists label_changes (
+    id bigserial primary key,
+    label_id text not null,
+    bound_serial_norm text,
+    deleted boolean not null default false,
+    created_at timestamptz not null default now()
+);
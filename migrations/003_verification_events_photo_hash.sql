@@ -0,0 +1,4 @@
+-- SHA-256 of the photo uploaded through POST /api/photos (content-addressed
+-- storage key), linked to the verification it was taken for.
+alter table verification_events
+    add column if not exists photo_hash text;
@@ -0,0 +1,7 @@
+-- Role carried in the session token issued by /api/auth/login.
+-- "auditor" (or "admin") may read verification history; everyone else is "staff".
+alter table employees
+    add column if not exists role text not null default 'staff';
+
+-- Keeps the one account that could view history before roles existed
+update employees set role = 'auditor' where employee_code = 'kimhai1234';
@@ -0,0 +1,123 @@
+-- Pre-aggregated verification counts behind /api/reports/verifications.
+-- Counts are kept per reporting dimension rather than per full event key
+-- (which is close to one row per event): `dims` names the columns a row is
+-- grouped by, and the other columns are empty strings.
+--   device    serial_norm, result
+--   employee  employee_code, result
+--   method    result, method
+-- grain is 'day' or 'month' and bucket is the first day of the period in
+-- the hospital's time zone (Asia/Ho_Chi_Minh, must match rollups.TIMEZONE).
+-- Empty strings also stand in for a missing device/employee/method so the
+-- columns can be part of the unique key.
+create table if not exists verification_rollups (
+    id bigint generated always as identity primary key,
+    grain text not null,
+    dims text not null,
+    bucket date not null,
+    serial_norm text not null default '',
+    employee_code text not null default '',
+    result text not null default '',
+    method text not null default '',
+    events integer not null default 0,
+    offline_events integer not null default 0,
+    updated_at timestamptz not null default now(),
+    unique (grain, dims, bucket, serial_norm, employee_code, result, method)
+);
+
+create index if not exists verification_rollups_grain_dims_bucket_idx
+    on verification_rollups (grain, dims, bucket, id);
+
+-- Statement-level, so a 200-row audit flush or offline batch costs one
+-- upsert of its distinct keys. The transition table only holds rows that
+-- were actually inserted: duplicates skipped by ON CONFLICT DO NOTHING
+-- (replayed offline events) are not counted twice. Buckets come from the
+-- event's own created_at, so back-dated offline events land in their day.
+create or replace function rollup_verification_events() returns trigger
+language plpgsql as $$
+begin
+    insert into verification_rollups as r
+        (grain, dims, bucket, serial_norm, employee_code, result, method, events, offline_events)
+    select ev.grain,
+           case when grouping(ev.serial_norm) = 0 then 'device'
+                when grouping(ev.employee_code) = 0 then 'employee'
+                else 'method' end,
+           ev.bucket,
+           coalesce(ev.serial_norm, ''),
+           coalesce(ev.employee_code, ''),
+           ev.result,
+           coalesce(ev.method, ''),
+           count(*),
+           count(*) filter (where ev.is_offline_event)
+    from (
+        select g.grain,
+               case g.grain
+                   when 'day' then (e.created_at at time zone 'Asia/Ho_Chi_Minh')::date
+                   else date_trunc('month', e.created_at at time zone 'Asia/Ho_Chi_Minh')::date
+               end as bucket,
+               coalesce(e.expected_serial_norm, '') as serial_norm,
+               coalesce(e.employee_code, '') as employee_code,
+               coalesce(e.result, '') as result,
+               coalesce(e.method, '') as method,
+               e.is_offline_event
+        from inserted e
+        cross join (values ('day'), ('month')) as g(grain)
+    ) ev
+    group by grouping sets (
+        (ev.grain, ev.bucket, ev.serial_norm, ev.result),
+        (ev.grain, ev.bucket, ev.employee_code, ev.result),
+        (ev.grain, ev.bucket, ev.result, ev.method)
+    )
+    on conflict (grain, dims, bucket, serial_norm, employee_code, result, method) do update
+        set events = r.events + excluded.events,
+            offline_events = r.offline_events + excluded.offline_events,
+            updated_at = now();
+    return null;
+end
+$$;
+
+-- Backfill and attach the trigger atomically, so no event is missed or counted twice.
+-- Re-running the insert after `truncate verification_rollups` rebuilds the table.
+begin;
+lock table verification_events in share row exclusive mode;
+
+drop trigger if exists verification_events_rollup on verification_events;
+create trigger verification_events_rollup
+    after insert on verification_events
+    referencing new table as inserted
+    for each statement execute function rollup_verification_events();
+
+insert into verification_rollups
+    (grain, dims, bucket, serial_norm, employee_code, result, method, events, offline_events)
+select ev.grain,
+       case when grouping(ev.serial_norm) = 0 then 'device'
+            when grouping(ev.employee_code) = 0 then 'employee'
+            else 'method' end,
+       ev.bucket,
+       coalesce(ev.serial_norm, ''),
+       coalesce(ev.employee_code, ''),
+       ev.result,
+       coalesce(ev.method, ''),
+       count(*),
+       count(*) filter (where ev.is_offline_event)
+from (
+    select g.grain,
+           case g.grain
+               when 'day' then (e.created_at at time zone 'Asia/Ho_Chi_Minh')::date
+               else date_trunc('month', e.created_at at time zone 'Asia/Ho_Chi_Minh')::date
+           end as bucket,
+           coalesce(e.expected_serial_norm, '') as serial_norm,
+           coalesce(e.employee_code, '') as employee_code,
+           coalesce(e.result, '') as result,
+           coalesce(e.method, '') as method,
+           e.is_offline_event
+    from verification_events e
+    cross join (values ('day'), ('month')) as g(grain)
+) ev
+group by grouping sets (
+    (ev.grain, ev.bucket, ev.serial_norm, ev.result),
+    (ev.grain, ev.bucket, ev.employee_code, ev.result),
+    (ev.grain, ev.bucket, ev.result, ev.method)
+)
+on conflict (grain, dims, bucket, serial_norm, employee_code, result, method) do nothing;
+
+commit;
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 from datetime import date, datetime
 
 class DeviceCreate(BaseModel):
@@ -22,18 +22,35 @@ class VerificationRequest(BaseModel):
     observed_serial_raw: Optional[str] = None 
     method: str = "SCAN" # SCAN, MANUAL
     
-    # New Employee Fields
-    employee_code: str
+    # New Employee Fields (optional for /api/verify, which takes it from the session token)
+    employee_code: Optional[str] = None
     
+    # Preferred: upload via POST /api/photos first and send the returned hash
+    photo_hash: Optional[str] = None
+    # Legacy inline photo, stored the same way as an upload
     device_photo_base64: Optional[str] = None
     notes: Optional[str] = None
     is_offline_event: bool = False
     created_at: Optional[datetime] = None
 
+class QueuedVerification(VerificationRequest):
+    # Client-side UUID from the IndexedDB queue, used as idempotency key
+    id: str
+    # Queued offline, possibly before the current session; always recorded explicitly
+    employee_code: str
+    # Session the scan was queued under; required when employee_code isn't the syncing session's
+    session_token: Optional[str] = None
+
+class BatchVerificationRequest(BaseModel):
+    # Unvalidated so one malformed event (even a non-object) doesn't reject the whole batch
+    events: List[Any]
+
 class VerificationResponse(BaseModel):
     result: str # PASS, FAIL, WARN
     message: str
     expected_serial: Optional[str] = None
+    # Nearest known serial to observed_serial_raw (OCR-tolerant), when one was sent
+    serial_match: Optional[Dict[str, Any]] = None
     # observed_serial_norm removed or optional
 
 class EmployeeLogin(BaseModel):
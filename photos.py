@@ -0,0 +1,414 @@
+import os
+import io
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import httpx
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from database import url as supabase_url, key as supabase_key
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
+
+MAX_BYTES = int(os.environ.get("PHOTO_MAX_BYTES", 10 * 1024 * 1024))
+THUMBNAIL_SIZE = int(os.environ.get("PHOTO_THUMBNAIL_SIZE", 320))
+THUMBNAIL_WORKERS = int(os.environ.get("PHOTO_THUMBNAIL_WORKERS", 2))
+LOCAL_ROOT = os.environ.get("PHOTO_DIR", os.path.join(os.path.dirname(__file__), "data", "photos"))
+CHUNK = 64 * 1024
+
+# Magic bytes at their offsets -> content type; anything else is rejected
+SIGNATURES = [
+    (((0, b"\xff\xd8\xff"),), "image/jpeg"),
+    (((0, b"\x89PNG\r\n\x1a\n"),), "image/png"),
+    # RIFF is a generic container (WAV, AVI too); the form type at offset 8 says WebP
+    (((0, b"RIFF"), (8, b"WEBP")), "image/webp"),
+]
+SNIFF_BYTES = 16
+
+
+class PhotoTooLarge(Exception):
+    pass
+
+
+class UnsupportedPhoto(Exception):
+    pass
+
+
+class BadUpload(Exception):
+    pass
+
+
+class UndecodablePhoto(Exception):
+    pass
+
+
+# What store.exists/put_file raise when the storage backend is down or refuses the write
+STORE_ERRORS = (httpx.HTTPError, OSError)
+
+
+def photo_key(digest):
+    return f"{digest[:2]}/{digest}"
+
+
+def thumbnail_key(digest):
+    return f"{digest[:2]}/{digest}.thumb.jpg"
+
+
+def is_digest(value):
+    return len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def sniff(head):
+    return next((t for parts, t in SIGNATURES if all(head.startswith(magic, offset) for offset, magic in parts)), None)
+
+
+IMMUTABLE = {"Cache-Control": "public, max-age=31536000, immutable"}
+
+
+class LocalPhotoStore:
+    def __init__(self, root=LOCAL_ROOT):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    async def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    async def put_file(self, key, path, content_type):
+        dest = self._path(key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # Same-filesystem rename when possible; content-addressed, so a race just rewrites identical bytes
+        await asyncio.to_thread(shutil.move, path, dest)
+
+    async def get_bytes(self, key):
+        return await asyncio.to_thread(_read_file, self._path(key))
+
+    async def response(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            content_type = sniff(f.read(SNIFF_BYTES)) or "application/octet-stream"
+        return FileResponse(path, media_type=content_type, headers=IMMUTABLE)
+
+    async def close(self):
+        pass
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _iter_file(path):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK)
+            if not chunk:
+                return
+            yield chunk
+
+
+class SupabasePhotoStore:
+    """Supabase Storage bucket, streamed through the storage REST API."""
+
+    def __init__(self, base_url, api_key, bucket):
+        self.base_url = base_url.rstrip("/") + "/storage/v1/object"
+        self.bucket = bucket
+        self.headers = {"apikey": api_key, "Authorization": f"Bearer {api_key}"}
+        self.client = None
+
+    def _client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(headers=self.headers, timeout=httpx.Timeout(30))
+        return self.client
+
+    async def exists(self, key):
+        resp = await self._client().head(f"{self.base_url}/{self.bucket}/{key}")
+        return resp.status_code == 200
+
+    async def put_file(self, key, path, content_type):
+        try:
+            resp = await self._client().post(
+                f"{self.base_url}/{self.bucket}/{key}",
+                content=_iter_file(path),
+                headers={"Content-Type": content_type, "x-upsert": "true"},
+            )
+            resp.raise_for_status()
+        finally:
+            os.remove(path)
+
+    async def get_bytes(self, key):
+        resp = await self._client().get(f"{self.base_url}/{self.bucket}/{key}")
+        resp.raise_for_status()
+        return resp.content
+
+    async def response(self, key):
+        client = self._client()
+        req = client.build_request("GET", f"{self.base_url}/{self.bucket}/{key}")
+        resp = await client.send(req, stream=True)
+        if resp.status_code != 200:
+            await resp.aclose()
+            return None
+        return StreamingResponse(
+            resp.aiter_bytes(),
+            media_type=resp.headers.get("content-type", "application/octet-stream"),
+            headers=IMMUTABLE,
+            background=BackgroundTask(resp.aclose),
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+def create_store():
+    backend = (os.environ.get("PHOTO_STORE") or "local").lower()
+    if backend == "supabase" and supabase_url and supabase_key:
+        return SupabasePhotoStore(supabase_url, supabase_key, os.environ.get("PHOTO_BUCKET", "device-photos"))
+    return LocalPhotoStore()
+
+
+store = create_store()
+
+
+async def save_stream(chunks):
+    """Spools an upload to a temp file while hashing it, then stores it under its SHA-256.
+
+    Returns (digest, content_type, size, created). Never holds more than one
+    chunk in memory; aborts as soon as MAX_BYTES is exceeded.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    head = b""
+    content_type = None
+    fd, tmp_path = tempfile.mkstemp(prefix="photo-", dir=_tmp_dir())
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in chunks:
+                if not chunk:
+                    continue
+                # Chunks can be shorter than the signatures: sniff once SNIFF_BYTES have arrived
+                if content_type is None and len(head) < SNIFF_BYTES:
+                    head += chunk[:SNIFF_BYTES - len(head)]
+                    if len(head) == SNIFF_BYTES:
+                        content_type = _require_photo(head)
+                size += len(chunk)
+                if size > MAX_BYTES:
+                    raise PhotoTooLarge(f"Photo exceeds {MAX_BYTES} bytes")
+                sha.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise UnsupportedPhoto("Empty upload")
+        content_type = content_type or _require_photo(head)
+
+        digest = sha.hexdigest()
+        key = photo_key(digest)
+        created = not await store.exists(key)
+        if created:
+            await store.put_file(key, tmp_path, content_type)
+        return digest, content_type, size, created
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _require_photo(head):
+    content_type = sniff(head)
+    if content_type is None:
+        raise UnsupportedPhoto("Only JPEG, PNG and WebP photos are accepted")
+    return content_type
+
+
+def _tmp_dir():
+    # Temp files next to local photos so the final move is a rename
+    if isinstance(store, LocalPhotoStore):
+        os.makedirs(store.root, exist_ok=True)
+        return store.root
+    return None
+
+
+async def iter_multipart_file(content_type, chunks, field="photo"):
+    """Yields the bytes of file field `field` from a multipart/form-data body as it arrives.
+
+    Unlike request.form(), nothing is spooled before the caller sees it, so
+    size limits hold for chunked uploads without a Content-Length. Raises
+    PhotoTooLarge once the whole body (other fields included) passes
+    MAX_BYTES plus room for the multipart framing.
+    """
+    _, params = parse_options_header(content_type or "")
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise BadUpload("Expected a multipart/form-data body")
+
+    part = {"headers": {}, "field": b"", "value": b"", "wanted": False, "done": False}
+    out = []
+
+    def on_part_begin():
+        part["headers"] = {}
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"] = part["value"] = b""
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["wanted"] = not part["done"] and options.get(b"name") == field.encode() and b"filename" in options
+
+    def on_part_data(data, start, end):
+        if part["wanted"]:
+            out.append(data[start:end])
+
+    def on_part_end():
+        if part["wanted"]:
+            part["wanted"] = False
+            part["done"] = True
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+    received = 0
+    async for chunk in chunks:
+        received += len(chunk)
+        if received > MAX_BYTES + 64 * 1024:
+            raise PhotoTooLarge(f"Photo exceeds {MAX_BYTES} bytes")
+        try:
+            parser.write(chunk)
+        except MultipartParseError as e:
+            raise BadUpload(f"Malformed multipart body: {e}")
+        if out:
+            yield b"".join(out)
+            out.clear()
+        if part["done"]:
+            return  # The rest of the body isn't needed
+    raise BadUpload(f"Missing multipart file field '{field}'")
+
+
+async def iter_bytes(data):
+    for i in range(0, len(data), CHUNK):
+        yield data[i:i + CHUNK]
+
+
+def render_thumbnail(data):
+    try:
+        from PIL import Image, UnidentifiedImageError
+    except ImportError:
+        return None
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            out = io.BytesIO()
+            img.convert("RGB").save(out, "JPEG", quality=80)
+            return out.getvalue()
+    # Passed the sniff but doesn't decode: truncated, corrupt (broken PNGs raise SyntaxError) or a pixel bomb
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise UndecodablePhoto(str(e))
+
+
+class ThumbnailWorker:
+    """Background thumbnail generation so uploads return as soon as the original is stored."""
+
+    def __init__(self, workers=THUMBNAIL_WORKERS, max_pending=100):
+        self.workers = workers
+        self.queue = None
+        self.max_pending = max_pending
+        self.tasks = []
+        self.generated = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        for t in self.tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self.tasks = []
+
+    def submit(self, digest):
+        if self.queue is None:
+            return
+        try:
+            self.queue.put_nowait(digest)
+        except asyncio.QueueFull:
+            # Generated on first request instead
+            self.skipped += 1
+
+    async def _run(self):
+        while True:
+            digest = await self.queue.get()
+            try:
+                await make_thumbnail(digest)
+                self.generated += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Thumbnail failed for {digest}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            "pending": self.queue.qsize() if self.queue else 0,
+            "generated": self.generated,
+            "failed": self.failed,
+            "skipped": self.skipped,
+        }
+
+
+# Digests whose original can't be decoded; content-addressed, so that never changes
+undecodable = {}
+MAX_UNDECODABLE = 10000
+
+
+async def make_thumbnail(digest):
+    """Stores the thumbnail for `digest`. False when none can be made; callers serve the original."""
+    if digest in undecodable:
+        return False
+    key = thumbnail_key(digest)
+    if await store.exists(key):
+        return True
+    data = await store.get_bytes(photo_key(digest))
+    try:
+        thumb = await asyncio.to_thread(render_thumbnail, data)
+    except UndecodablePhoto as e:
+        print(f"No thumbnail for {digest}, serving the original: {e}")
+        if len(undecodable) >= MAX_UNDECODABLE:
+            del undecodable[next(iter(undecodable))]
+        undecodable[digest] = True
+        return False
+    if thumb is None:
+        return False
+    fd, tmp_path = tempfile.mkstemp(prefix="thumb-", dir=_tmp_dir())
+    with os.fdopen(fd, "wb") as f:
+        f.write(thumb)
+    await store.put_file(key, tmp_path, "image/jpeg")
+    return True
+
+
+thumbnails = ThumbnailWorker()
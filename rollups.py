@@ -0,0 +1,235 @@
+import io
+import csv
+import datetime
+from zoneinfo import ZoneInfo
+from database import db, MemoryBackend
+import cache
+
+TABLE = "verification_rollups"
+# Bucket boundaries; must match the zone in migrations/005_verification_rollups.sql
+TIMEZONE = ZoneInfo("Asia/Ho_Chi_Minh")
+PAGE_SIZE = 1000
+
+KEY_COLUMNS = ("grain", "dims", "bucket", "serial_norm", "employee_code", "result", "method")
+# dims -> the columns its rows are grouped by (the rest are ""), smallest first; must match the migration
+ROLLUPS = {
+    "method": ("result", "method"),
+    "employee": ("employee_code", "result"),
+    "device": ("serial_norm", "result"),
+}
+INTERVALS = ("day", "week", "month", "quarter")
+# group_by name -> rollup column (model is resolved from the device)
+DIMENSIONS = {"device": "serial_norm", "model": "serial_norm", "employee": "employee_code", "result": "result", "method": "method"}
+RESULTS = ("PASS", "FAIL", "WARN")
+
+
+def local_date(created_at):
+    if isinstance(created_at, str):
+        created_at = datetime.datetime.fromisoformat(created_at)
+    if created_at.tzinfo is None:
+        # timestamptz reads naive input as UTC (the Supabase session zone)
+        created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+    return created_at.astimezone(TIMEZONE).date()
+
+
+def period_start(day, interval):
+    if interval == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    if interval == "quarter":
+        return datetime.date(day.year, (day.month - 1) // 3 * 3 + 1, 1)
+    return day
+
+
+def today():
+    return datetime.datetime.now(TIMEZONE).date()
+
+
+def _rollup_events(backend, events):
+    # Same aggregation as rollup_verification_events() in the migration
+    store = backend._table(TABLE)
+    keys = backend._index(TABLE, "key")
+    for e in events:
+        day = local_date(e["created_at"])
+        values = {
+            "serial_norm": e.get("expected_serial_norm") or "",
+            "employee_code": e.get("employee_code") or "",
+            "result": e.get("result") or "",
+            "method": e.get("method") or "",
+        }
+        for grain, bucket in (("day", day), ("month", day.replace(day=1))):
+            for dims, columns in ROLLUPS.items():
+                key = (grain, dims, bucket.isoformat(),
+                       *(values[c] if c in columns else "" for c in ("serial_norm", "employee_code", "result", "method")))
+                row_id = keys.get(key)
+                if row_id is None:
+                    row = backend._insert(TABLE, [dict(zip(KEY_COLUMNS, key), events=0, offline_events=0)])[0]
+                    row_id = keys[key] = row["id"]
+                row = store[row_id]
+                row["events"] += 1
+                row["offline_events"] += 1 if e.get("is_offline_event") else 0
+
+
+MemoryBackend.TRIGGERS.setdefault("verification_events", []).append(_rollup_events)
+
+
+def pick_rollup(columns):
+    # Smallest rollup grouped by every column the report needs, or None (raw events then)
+    return next((dims for dims, grouped in ROLLUPS.items() if set(columns) <= set(grouped)), None)
+
+
+async def iter_rollups(grain, dims, since, until, serial_norm=None, employee_code=None, result=None, method=None):
+    """Rollup rows for [since, until), oldest bucket first, one page at a time (keyset on bucket, id)."""
+    last = None
+    while True:
+        q = db.table(TABLE).select("id, bucket, serial_norm, employee_code, result, method, events, offline_events")
+        q = q.eq("grain", grain).eq("dims", dims).gte("bucket", since.isoformat()).lt("bucket", until.isoformat())
+        for column, value in (("serial_norm", serial_norm), ("employee_code", employee_code), ("result", result), ("method", method)):
+            if value:
+                q = q.eq(column, value)
+        if last is not None:
+            q = q.or_(("bucket", "gt", last["bucket"]), [("bucket", "eq", last["bucket"]), ("id", "gt", last["id"])])
+        res = await q.order("bucket").order("id").limit(PAGE_SIZE).execute()
+        if res.data:
+            yield res.data
+        if len(res.data) < PAGE_SIZE:
+            return
+        last = res.data[-1]
+
+
+def _local_midnight_utc(day):
+    return datetime.datetime.combine(day, datetime.time(), TIMEZONE).astimezone(datetime.timezone.utc).isoformat()
+
+
+async def iter_events(since, until, serial_norm=None, employee_code=None, result=None, method=None):
+    """Raw events for [since, until) as one-event rollup rows, oldest first (keyset on created_at, id).
+
+    For reports combining dimensions no rollup keeps together, e.g. device by employee.
+    """
+    last = None
+    while True:
+        q = db.table("verification_events").select("id, created_at, expected_serial_norm, employee_code, result, method, is_offline_event")
+        q = q.gte("created_at", _local_midnight_utc(since)).lt("created_at", _local_midnight_utc(until))
+        for column, value in (("expected_serial_norm", serial_norm), ("employee_code", employee_code), ("result", result), ("method", method)):
+            if value:
+                q = q.eq(column, value)
+        if last is not None:
+            q = q.or_(("created_at", "gt", last["created_at"]), [("created_at", "eq", last["created_at"]), ("id", "gt", last["id"])])
+        res = await q.order("created_at").order("id").limit(PAGE_SIZE).execute()
+        if res.data:
+            yield [{
+                "bucket": local_date(e["created_at"]).isoformat(),
+                "serial_norm": e.get("expected_serial_norm") or "",
+                "employee_code": e.get("employee_code") or "",
+                "result": e.get("result") or "",
+                "method": e.get("method") or "",
+                "events": 1,
+                "offline_events": 1 if e.get("is_offline_event") else 0,
+            } for e in res.data]
+        if len(res.data) < PAGE_SIZE:
+            return
+        last = res.data[-1]
+
+
+class Report:
+    """Verification counts per period and chosen dimensions, summed from the rollup tables.
+
+    Reads the smallest rollup covering the grouping and filters, month rows
+    when the range and interval allow it and day rows otherwise; groupings no
+    rollup covers are summed from the raw events. Buckets arrive in order, so
+    each period is emitted as soon as the next one starts and only one
+    period's groups are held at a time.
+    """
+
+    def __init__(self, since, until, interval="day", group_by=(), **filters):
+        self.since = since
+        self.until = until
+        self.interval = interval
+        self.group_by = [d for d in DIMENSIONS if d in group_by]
+        self.filters = filters
+        month_aligned = since.day == 1 and until.day == 1
+        self.grain = "month" if interval in ("month", "quarter") and month_aligned else "day"
+        needed = {DIMENSIONS[d] for d in self.group_by} | {c for c, v in filters.items() if v} | {"result"}
+        self.dims = pick_rollup(needed)
+        # Per-result count columns, unless results are already split into rows
+        self.result_columns = [] if "result" in self.group_by else [r.lower() for r in RESULTS]
+        self.columns = ["period", *self.group_by, "events", *self.result_columns, "offline_events"]
+        self.models = {}
+
+    async def _emit(self, period, groups):
+        if "model" in self.group_by:
+            serials = {key[self.group_by.index("model")] for key in groups} - self.models.keys() - {""}
+            if serials:
+                devices = await cache.get_devices(serials)
+                self.models.update({sn: (devices.get(sn) or {}).get("model") or "Unknown Device" for sn in serials})
+        rows = []
+        for key in sorted(groups):
+            row = {"period": period.isoformat()}
+            for dim, value in zip(self.group_by, key):
+                if dim == "model":
+                    value = self.models.get(value, "Unknown Device")
+                row[dim] = value or None
+            row.update(groups[key])
+            rows.append(row)
+        if "model" in self.group_by:
+            rows = _merge_models(rows, self.group_by)
+        return rows
+
+    async def iter_periods(self):
+        period, groups = None, {}
+        if self.dims is None:
+            pages = iter_events(self.since, self.until, **self.filters)
+        else:
+            pages = iter_rollups(self.grain, self.dims, self.since, self.until, **self.filters)
+        async for page in pages:
+            for r in page:
+                start = period_start(datetime.date.fromisoformat(str(r["bucket"])[:10]), self.interval)
+                if start != period:
+                    if groups:
+                        yield await self._emit(period, groups)
+                    period, groups = start, {}
+                key = tuple(r[DIMENSIONS[d]] for d in self.group_by)
+                counts = groups.get(key)
+                if counts is None:
+                    counts = groups[key] = dict.fromkeys(["events", *self.result_columns, "offline_events"], 0)
+                counts["events"] += r["events"]
+                counts["offline_events"] += r["offline_events"]
+                result_column = (r["result"] or "").lower()
+                if result_column in self.result_columns:
+                    counts[result_column] += r["events"]
+        if groups:
+            yield await self._emit(period, groups)
+
+    async def rows(self):
+        out = []
+        async for rows in self.iter_periods():
+            out.extend(rows)
+        return out
+
+    async def export_csv(self):
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=self.columns)
+        writer.writeheader()
+        async for rows in self.iter_periods():
+            writer.writerows(rows)
+            if buf.tell() >= 64 * 1024:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+
+
+def _merge_models(rows, group_by):
+    # Several devices share a model: fold their rows once serials are replaced by the model name
+    merged = {}
+    for row in rows:
+        key = tuple(row[d] for d in group_by)
+        if key not in merged:
+            merged[key] = dict(row)
+            continue
+        for column, value in row.items():
+            if column != "period" and column not in group_by:
+                merged[key][column] += value
+    return sorted(merged.values(), key=lambda r: tuple(r[d] or "" for d in group_by))
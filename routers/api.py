@@ -1,10 +1,28 @@
 import unicodedata
 import re
-from fastapi import APIRouter, HTTPException, Header, Depends, Body
-from models import DeviceCreate, LabelBind, VerificationRequest, VerificationResponse, EmployeeLogin, PasswordChange
-from database import supabase
+from fastapi import APIRouter, HTTPException, Header, Depends, Body, Request, Response, Query
+from fastapi.responses import StreamingResponse
+from typing import Optional
+from pydantic import ValidationError
+from models import DeviceCreate, LabelBind, VerificationRequest, QueuedVerification, BatchVerificationRequest, VerificationResponse, EmployeeLogin, PasswordChange
+from database import db
+import cache
+import audit
+import label_sync
+import history
+import rollups
+from device_history import device_history, group_events
+from device_import import DeviceImporter, iter_lines, iter_records
+from serial_index import serial_index
+from mapping_index import mapping_index, MAX_LIMIT as MAPPINGS_MAX_LIMIT
+import photos
+import metrics
+import session
+import base64
+import binascii
 from utils import normalize_serial
 import datetime
+import asyncio
 
 router = APIRouter(prefix="/api")
 
@@ -25,23 +43,29 @@ async def check_admin():
 async def login(creds: EmployeeLogin):
     # Simple cleartext password check as requested "pass is 1234"
     # In production, use hashing (bcrypt).
-    res = supabase.table("employees").select("*").eq("employee_code", creds.employee_code).eq("password_text", creds.password).execute()
+    res = await db.table("employees").select("*").eq("employee_code", creds.employee_code).eq("password_text", creds.password).execute()
     
     if not res.data:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     employee = res.data[0]
+    role = employee.get('role') or session.DEFAULT_ROLE
+    # Signed claims stand in for the employees lookup on every later request
+    token, claims = session.signer.issue(employee['employee_code'], employee['full_name'], role)
     return {
         "status": "ok",
         "employee_code": employee['employee_code'],
         "full_name": employee['full_name'],
-        "is_first_login": employee['is_first_login']
+        "is_first_login": employee['is_first_login'],
+        "role": role,
+        "token": token,
+        "expires_at": claims['exp'],
     }
 
 @router.post("/auth/change-password")
 async def change_password(data: PasswordChange):
     # Verify old password first
-    res = supabase.table("employees").select("*").eq("employee_code", data.employee_code).eq("password_text", data.old_password).execute()
+    res = await db.table("employees").select("*").eq("employee_code", data.employee_code).eq("password_text", data.old_password).execute()
     if not res.data:
         raise HTTPException(status_code=401, detail="Invalid old password")
     
@@ -50,7 +74,7 @@ async def change_password(data: PasswordChange):
         raise HTTPException(status_code=400, detail="New password cannot be the same as the old password")
     
     # Update to new password and set is_first_login = false
-    update_res = supabase.table("employees").update({
+    update_res = await db.table("employees").update({
         "password_text": data.new_password, 
         "is_first_login": False
     }).eq("employee_code", data.employee_code).execute()
@@ -67,16 +91,36 @@ async def create_device(device: DeviceCreate, _ = Depends(verify_admin)):
     data['created_at'] = datetime.datetime.now().isoformat()
     
     try:
-        response = supabase.table("devices").insert(data).execute()
+        response = await db.table("devices").insert(data).execute()
+        cache.device_cache.invalidate(serial_norm)
+        for d in response.data:
+            device_history.on_device(d)
+            serial_index.add(d['serial_norm'])
+            mapping_index.on_device(d)
         return response.data
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.post("/devices/import", dependencies=[Depends(verify_admin)])
+async def import_devices(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    create_devices: bool = True,
+    rebind: bool = False,
+):
+    # Bulk onboarding: rows of serial_raw, model, mfg_date, label_id as CSV (with header) or NDJSON.
+    # The body is read as a stream and processed in chunks.
+    if not format:
+        content_type = request.headers.get("content-type", "")
+        format = "ndjson" if "ndjson" in content_type or "json" in content_type else "csv"
+    importer = DeviceImporter(create_devices=create_devices, rebind=rebind)
+    return await importer.run(iter_records(iter_lines(request.stream()), format))
+
 @router.post("/labels/bind")
 async def bind_label(bind: LabelBind, _ = Depends(verify_admin)):
     serial_norm = normalize_serial(bind.serial_raw)
     
-    device_res = supabase.table("devices").select("serial_norm").eq("serial_norm", serial_norm).execute()
+    device_res = await db.table("devices").select("serial_norm").eq("serial_norm", serial_norm).execute()
     if not device_res.data:
         raise HTTPException(status_code=404, detail=f"Device with normalized serial {serial_norm} not found. Create device first.")
 
@@ -87,33 +131,112 @@ async def bind_label(bind: LabelBind, _ = Depends(verify_admin)):
     }
     
     try:
-        response = supabase.table("labels").upsert(data).execute()
+        response = await db.table("labels").upsert(data).execute()
+        cache.label_cache.invalidate(bind.label_id)
+        await label_sync.record_changes([(bind.label_id, serial_norm)])
+        await device_history.on_bind({bind.label_id: serial_norm})
         return response.data
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@router.get("/serials/match")
+async def match_serial(q: str, max_distance: float = Query(2, ge=0, le=4), limit: int = Query(5, ge=1, le=50)):
+    # Nearest known serials to an OCR reading, tolerant of O/0, I/1/L, S/5, B/8 style misreads.
+    # max_distance is clamped to serial_index.MAX_DISTANCE_LIMIT. The index is warmed at
+    # startup; until then there's nothing to match against.
+    if not serial_index.loaded:
+        return []
+    return await serial_index.match(q, max_distance=max_distance, limit=limit)
+
+async def observed_serial_match(observed_serial_raw, expected_serial_norm):
+    matches = await serial_index.match(observed_serial_raw, limit=1) if serial_index.loaded else []
+    if not matches:
+        return {"serial_norm": None, "distance": None, "matches_expected": False}
+    best = matches[0]
+    return {**best, "matches_expected": best["serial_norm"] == expected_serial_norm}
+
+# --- Photo Endpoints ---
+
+@router.post("/photos")
+async def upload_photo(request: Request):
+    # Multipart upload (field "photo"). Stored under its SHA-256, so identical photos are kept once.
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > photos.MAX_BYTES + 64 * 1024:
+        raise HTTPException(status_code=413, detail=f"Photo exceeds {photos.MAX_BYTES} bytes")
+
+    # Parsed as it arrives, so the size limit also holds without a Content-Length
+    chunks = photos.iter_multipart_file(request.headers.get("content-type"), request.stream())
+    try:
+        digest, content_type, size, created = await photos.save_stream(chunks)
+    except photos.BadUpload as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except photos.PhotoTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except photos.UnsupportedPhoto as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except photos.STORE_ERRORS as e:
+        print(f"Photo storage failed: {e}")
+        raise HTTPException(status_code=503, detail="Photo storage unavailable, try again later")
+
+    if created:
+        photos.thumbnails.submit(digest)
+    return {
+        "photo_hash": digest,
+        "content_type": content_type,
+        "size": size,
+        "deduplicated": not created,
+        "url": f"/api/photos/{digest}",
+        "thumbnail_url": f"/api/photos/{digest}/thumbnail",
+    }
+
+@router.get("/photos/{digest}")
+async def get_photo(digest: str):
+    if not photos.is_digest(digest):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    response = await photos.store.response(photos.photo_key(digest))
+    if response is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return response
+
+@router.get("/photos/{digest}/thumbnail")
+async def get_photo_thumbnail(digest: str):
+    if not photos.is_digest(digest):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    response = await photos.store.response(photos.thumbnail_key(digest))
+    if response is None:
+        # Not generated yet (or the worker skipped it): make it now, else fall back to the original
+        if await photos.store.exists(photos.photo_key(digest)) and await photos.make_thumbnail(digest):
+            response = await photos.store.response(photos.thumbnail_key(digest))
+        else:
+            response = await photos.store.response(photos.photo_key(digest))
+    if response is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return response
+
+@router.get("/labels/sync")
+async def sync_labels(request: Request, response: Response, since: int = 0):
+    # Feed for the client-side offline label cache: full snapshot, or only what changed since `since`
+    version = await label_sync.current_version()
+    etag = f'W/"labels-{version}"'
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return await label_sync.changes_since(since, version)
+
 @router.get("/labels/{label_id}")
 async def get_label(label_id: str):
-    response = supabase.table("labels").select("bound_serial_norm, devices(*)").eq("label_id", label_id).eq("active", True).execute()
-    if not response.data:
+    serial_norm = await cache.get_bound_serial(label_id)
+    if not serial_norm:
         raise HTTPException(status_code=404, detail="Label not found or inactive")
-    return response.data[0]
+    return {
+        "bound_serial_norm": serial_norm,
+        "devices": await cache.get_device(serial_norm)
+    }
 
 # --- Verification Endpoints ---
 
-@router.post("/verify")
-async def verify_event(req: VerificationRequest):
-    # 1. Lookup Employee
-    emp_res = supabase.table("employees").select("full_name").eq("employee_code", req.employee_code).execute()
-    employee_name = emp_res.data[0]['full_name'] if emp_res.data else "Unknown"
-
-    # 2. Look up Label
-    label_res = supabase.table("labels").select("bound_serial_norm").eq("label_id", req.label_id).eq("active", True).execute()
-    
-    expected_serial_norm = None
-    if label_res.data:
-        expected_serial_norm = label_res.data[0]['bound_serial_norm']
-
+def build_verification(req: VerificationRequest, employee_name: str, expected_serial_norm):
     result = "FAIL"
     message = "Label not found"
     
@@ -131,7 +254,6 @@ async def verify_event(req: VerificationRequest):
     # We still record what was observed if sent, but it's not the diff factor
     observed_serial_norm = normalize_serial(req.observed_serial_raw) if req.observed_serial_raw else None
     
-    # Log event
     event_data = {
         "actor_name": employee_name, # Mapping existing field to employee name
         "employee_code": req.employee_code,
@@ -145,122 +267,274 @@ async def verify_event(req: VerificationRequest):
         "notes": req.notes,
         "is_offline_event": req.is_offline_event
     }
-    if req.created_at:
-        event_data["created_at"] = req.created_at.isoformat()
+    if req.photo_hash and photos.is_digest(req.photo_hash):
+        event_data["photo_hash"] = req.photo_hash
+    # Stamped here rather than by the database default: the row may be written later by the audit writer
+    event_data["created_at"] = (req.created_at or datetime.datetime.now(datetime.timezone.utc)).isoformat()
     
+    return result, message, event_data
+
+async def store_inline_photo(data_b64):
+    # Legacy path: clients that still send the photo inline get it stored instead of dropped
+    if "," in data_b64[:64]:
+        data_b64 = data_b64.split(",", 1)[1]  # data:image/jpeg;base64,...
     try:
-        supabase.table("verification_events").insert(event_data).execute()
-    except Exception as e:
-        print(f"Failed to log event: {e}") 
+        data = await asyncio.to_thread(base64.b64decode, data_b64, validate=False)
+        digest, _, _, created = await photos.save_stream(photos.iter_bytes(data))
+    except (binascii.Error, photos.PhotoTooLarge, photos.UnsupportedPhoto) as e:
+        print(f"Inline photo rejected: {e}")
+        return None
+    except photos.STORE_ERRORS as e:
+        # The scan is still recorded, just without its photo
+        print(f"Inline photo not stored: {e}")
+        return None
+    if created:
+        photos.thumbnails.submit(digest)
+    return digest
+
+@router.post("/verify")
+async def verify_event(req: VerificationRequest, claims: dict = Depends(session.require_session)):
+    # 1. Employee comes from the signed session, no lookup
+    if req.employee_code and req.employee_code != claims['sub']:
+        raise HTTPException(status_code=403, detail="employee_code does not match the session")
+    req.employee_code = claims['sub']
+    employee_name = claims['name']
+
+    # 2. Look up Label (cached, invalidated on bind/delete)
+    expected_serial_norm = await cache.get_bound_serial(req.label_id)
+
+    if req.device_photo_base64 and not req.photo_hash:
+        req.photo_hash = await store_inline_photo(req.device_photo_base64)
+    elif req.photo_hash and not photos.is_digest(req.photo_hash):
+        raise HTTPException(status_code=400, detail="Invalid photo_hash")
+
+    result, message, event_data = build_verification(req, employee_name, expected_serial_norm)
+    
+    # Log event (write-behind, flushed in bulk by the audit writer)
+    audit.writer.submit(event_data)
+    await device_history.record(event_data)
+        
+    serial_match = None
+    if req.observed_serial_raw:
+        serial_match = await observed_serial_match(req.observed_serial_raw, expected_serial_norm)
         
     return VerificationResponse(
         result=result,
         message=message,
         expected_serial=expected_serial_norm,
+        serial_match=serial_match,
         # observed_serial_norm remove from response or make optional/None
     )
+
+MAX_BATCH_EVENTS = 500
+
+@router.post("/verify/batch")
+async def verify_batch(batch: BatchVerificationRequest, claims: dict = Depends(session.require_session)):
+    # Replays the offline IndexedDB queue. Each event carries its client UUID (`id`),
+    # stored as client_event_id so a replay after a lost response never double-inserts.
+    # A device can hold scans by an employee who has since logged out: those are only
+    # taken with the (possibly expired) session token they were queued under.
+    if len(batch.events) > MAX_BATCH_EVENTS:
+        raise HTTPException(status_code=413, detail=f"Too many events in one batch (max {MAX_BATCH_EVENTS})")
+    metrics.sync_batch_size.observe(value=len(batch.events))
+
+    results = {}
+    queued = {}
+    names = {claims['sub']: claims['name']}
+    order = []
+    for index, raw in enumerate(batch.events):
+        if not isinstance(raw, dict) or raw.get("id") is None:
+            # Nothing to key it by: reported by position so the client can still drop it
+            results[index] = {"id": None, "index": index, "status": "invalid", "message": "Event must be an object with an id"}
+            order.append(index)
+            continue
+        event_id = str(raw["id"])
+        try:
+            event = QueuedVerification(**raw)
+        except ValidationError as e:
+            if event_id not in results:
+                results[event_id] = {"id": event_id, "index": index, "status": "invalid", "message": str(e)}
+                order.append(event_id)
+            continue
+        # Same event queued twice in one batch: keep the first
+        if event.id in queued or event.id in results:
+            continue
+        order.append(event.id)
+        if event.employee_code != claims['sub']:
+            owner = session.queued_claims(event.session_token, event.employee_code)
+            if owner is None:
+                results[event.id] = {"id": event.id, "status": "unauthorized", "message": "Event was not queued under its employee's session"}
+                continue
+            names[event.employee_code] = owner['name']
+        queued[event.id] = event
+
+    if queued:
+        # 1. One lookup for all labels; employee names come from the sessions
+        bound = await cache.get_bound_serials({e.label_id for e in queued.values()})
+
+        # 2. Evaluate in memory
+        rows = []
+        for event_id, event in queued.items():
+            result, message, event_data = build_verification(event, names[event.employee_code], bound.get(event.label_id))
+            event_data["client_event_id"] = event_id
+            rows.append(event_data)
+            results[event_id] = {
+                "id": event_id,
+                "status": "created",
+                "result": result,
+                "message": message,
+                "expected_serial": event_data["expected_serial_norm"],
+            }
+
+        # 3. Bulk insert, skipping events already stored by an earlier replay
+        try:
+            insert_res = await db.table("verification_events").upsert(rows, on_conflict="client_event_id", ignore_duplicates=True).execute()
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Failed to store events: {e}")
+
+        inserted = {r.get('client_event_id') for r in insert_res.data}
+        for event_id in queued:
+            if event_id not in inserted:
+                results[event_id]["status"] = "duplicate"
+        for row in rows:
+            if row["client_event_id"] in inserted:
+                await device_history.record(row)
+
+    for r in results.values():
+        metrics.sync_events.inc(r["status"])
+    return {"results": [results[event_id] for event_id in order]}
     
-@router.get("/events")
-async def list_events(limit: int = 50, x_employee_code: str = Header(None)):
-    # Permission Check
-    if x_employee_code != "kimhai1234":
-        raise HTTPException(status_code=403, detail="Access denied. Only kimhai1234 can view history.")
+def event_filters(
+    employee_code: Optional[str] = None,
+    label_id: Optional[str] = None,
+    result: Optional[str] = None,
+    since: Optional[datetime.datetime] = None,
+    until: Optional[datetime.datetime] = None,
+):
+    return {"employee_code": employee_code, "label_id": label_id, "result": result, "since": since, "until": until}
+
+async def fetch_events_page(response: Response, limit: int, cursor: Optional[str], filters: dict):
+    # Keyset page; the cursor for the next (older) page goes out in X-Next-Cursor
+    try:
+        rows, next_cursor = await history.fetch_page(limit, cursor, **filters)
+    except history.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return rows
+
+@router.get("/events", dependencies=[Depends(session.require_history_role)])
+async def list_events(response: Response, limit: int = 50, cursor: Optional[str] = None, filters: dict = Depends(event_filters)):
+    return await fetch_events_page(response, limit, cursor, filters)
+
+@router.get("/events/export", dependencies=[Depends(session.require_history_role)])
+async def export_events(format: str = Query("ndjson", pattern="^(ndjson|csv)$"), filters: dict = Depends(event_filters)):
+    # Streams the whole filtered history page by page, never holding it all in memory
+    if format == "csv":
+        return StreamingResponse(
+            history.export_csv(**filters),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="verification_events.csv"'}
+        )
+    return StreamingResponse(
+        history.export_ndjson(**filters),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="verification_events.ndjson"'}
+    )
+
+@router.get("/reports/verifications", dependencies=[Depends(session.require_history_role)])
+async def verification_report(
+    since: Optional[datetime.date] = None,
+    until: Optional[datetime.date] = None,
+    interval: str = Query("day", pattern="^(day|week|month|quarter)$"),
+    group_by: str = "",
+    serial_norm: Optional[str] = None,
+    employee_code: Optional[str] = None,
+    result: Optional[str] = None,
+    method: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|csv)$"),
+):
+    # Counts per period (since inclusive, until exclusive, local dates; last 30 days by default),
+    # summed from the rollup tables instead of scanning verification_events
+    until = until or rollups.today() + datetime.timedelta(days=1)
+    since = since or until - datetime.timedelta(days=30)
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    dims = [d.strip() for d in group_by.split(",") if d.strip()]
+    unknown = [d for d in dims if d not in rollups.DIMENSIONS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown group_by {', '.join(unknown)} (use {', '.join(rollups.DIMENSIONS)})")
 
-    response = supabase.table("verification_events").select("*").order("created_at", desc=True).limit(limit).execute()
-    return response.data
+    report = rollups.Report(since, until, interval, dims, serial_norm=serial_norm, employee_code=employee_code, result=result, method=method)
+    if format == "csv":
+        filename = f"verifications_{since.isoformat()}_{until.isoformat()}_{interval}.csv"
+        return StreamingResponse(
+            report.export_csv(),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+        )
+    return {
+        "since": since,
+        "until": until,
+        "interval": interval,
+        "group_by": report.group_by,
+        "columns": report.columns,
+        "rows": await report.rows(),
+    }
 
 @router.get("/admin/mappings", dependencies=[Depends(verify_admin)])
-async def list_mappings():
-    # Join labels with devices to get model/serial info.
-    # Supabase/PostgREST syntax: select=*,devices(*)
-    response = supabase.table("labels").select("label_id, active, bound_serial_norm, devices(serial_raw, model, status)").eq("active", True).execute()
-    return response.data
+async def list_mappings(
+    q: Optional[str] = None,
+    field: Optional[str] = Query(None, pattern="^(label_id|serial|model)$"),
+    match: str = Query("contains", pattern="^(prefix|contains)$"),
+    sort: str = Query("label_id", pattern="^(label_id|serial|model)$"),
+    desc: bool = False,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=MAPPINGS_MAX_LIMIT),
+):
+    # One page of active mappings (label joined with its device) plus the total match count,
+    # served from the in-memory index instead of returning the whole labels table
+    return await mapping_index.search(q, field, match, sort, desc, offset, limit)
 
 @router.delete("/admin/mappings", dependencies=[Depends(verify_admin)])
 async def delete_mapping(label_id: str):
     # Changed to Query Parameter to handle special characters/URLs in label_id safely.
     
     # Check if exists
-    res = supabase.table("labels").select("*").eq("label_id", label_id).execute()
+    res = await db.table("labels").select("*").eq("label_id", label_id).execute()
     if not res.data:
         raise HTTPException(status_code=404, detail="Mapping not found")
         
     # Hard Delete as requested to ensure history and verification treat it as completely unknown
-    supabase.table("labels").delete().eq("label_id", label_id).execute()
+    await db.table("labels").delete().eq("label_id", label_id).execute()
+    cache.label_cache.invalidate(label_id)
+    # Tombstone so offline clients drop it on their next sync
+    await label_sync.record_changes([(label_id, None)])
+    device_history.on_delete(label_id)
     return {"status": "ok", "message": "Mapping deleted permanently"}
 
-@router.get("/history/grouped")
-async def list_history_grouped(x_employee_code: str = Header(None)):
-    if x_employee_code != "kimhai1234":
-         raise HTTPException(status_code=403, detail="Access denied.")
+@router.get("/admin/cache", dependencies=[Depends(verify_admin)])
+async def cache_stats():
+    return cache.stats()
 
-    events_res = supabase.table("verification_events").select("*").order("created_at", desc=True).limit(200).execute()
-    events = events_res.data
-    
+@router.get("/admin/audit", dependencies=[Depends(verify_admin)])
+async def audit_stats():
+    return audit.writer.stats()
+
+@router.get("/history/grouped", dependencies=[Depends(session.require_history_role)])
+async def list_history_grouped(response: Response, limit: int = Query(200, ge=1, le=history.MAX_PAGE_SIZE), cursor: Optional[str] = None, filters: dict = Depends(event_filters)):
+    # Default view: the newest `limit` logs from the incrementally maintained per-device rings,
+    # already serialized; "Load more" continues with raw pages from the oldest log returned
+    if not cursor and not any(filters.values()):
+        await device_history.load()
+        page = device_history.page(limit)
+        if page is not None:
+            body, next_cursor = page
+            headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+            return Response(content=body, media_type="application/json", headers=headers)
+
+    # Paging into older history or filtering: group one page of raw events
+    events = await fetch_events_page(response, limit, cursor, filters)
     if not events:
         return []
-    
-    # RECOVERY LOGIC: Identify events with missing expected_serial_norm but assume they might have a label map now
-    # This helps "fix" display for previous events where we didn't save the serial, OR if we just want robust display.
-    # We can try to look up label_id -> serial for events where expected_serial_norm is null/empty.
-    
-    # 1. Collect Label IDs from events that lack serial but have label_id
-    missing_serial_labels = {e['label_id'] for e in events if not e.get('expected_serial_norm') and e.get('label_id')}
-    
-    recovered_map = {}
-    if missing_serial_labels:
-        # Fetch bound serials for these labels
-        # Note: We look up even if active=False (history)
-        l_res = supabase.table("labels").select("label_id, bound_serial_norm").in_("label_id", list(missing_serial_labels)).execute()
-        for r in l_res.data:
-            recovered_map[r['label_id']] = r['bound_serial_norm']
-
-    # 2. Collect All Serials (Existing + Recovered)
-    serials = set()
-    for e in events:
-        sn = e.get('expected_serial_norm')
-        # Try recover
-        if not sn and e.get('label_id') in recovered_map:
-            sn = recovered_map[e['label_id']]
-            # Patch the event object temporarily for this request so grouping works
-            e['expected_serial_norm'] = sn
-            
-        if sn:
-            serials.add(sn)
-    
-    devices_map = {}
-    if serials:
-        dev_res = supabase.table("devices").select("*").in_("serial_norm", list(serials)).execute()
-        for d in dev_res.data:
-            devices_map[d['serial_norm']] = d
-            
-    grouped = {}
-    
-    for e in events:
-        sn = e.get('expected_serial_norm')
-        
-        if not sn:
-            sn = "UNKNOWN_OR_URL" # E.g. URL redirect events don't have expected serial
-            
-        if sn not in grouped:
-            dev_info = devices_map.get(sn, {})
-            # Fallback if device not found but serial exists (Deleted device?)
-            model = dev_info.get("model", "Unknown Device")
-            if not dev_info and sn != "UNKNOWN_OR_URL":
-                 model = f"Unknown Device ({sn})"
-            
-            grouped[sn] = {
-                "device_serial_norm": sn,
-                "device_model": model,
-                "device_serial_raw": dev_info.get("serial_raw", sn),
-                "access_logs": []
-            }
-            
-        grouped[sn]["access_logs"].append({
-            "employee_code": e.get("employee_code"),
-            "employee_name": e.get("employee_name") or e.get("actor_name"),
-            "timestamp": e.get("created_at"),
-            "result": e.get("result")
-        })
-        
-    return list(grouped.values())
+    return await group_events(events)
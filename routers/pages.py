@@ -1,19 +1,16 @@
-from fastapi import APIRouter
-from fastapi.responses import FileResponse
-import os
+from fastapi import APIRouter, Request
+import static_assets
 
 router = APIRouter()
 
-STATIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'static')
-
 @router.get("/")
-async def index():
-    return FileResponse(os.path.join(STATIC_DIR, 'index.html'))
+async def index(request: Request):
+    return static_assets.page('index.html', request.headers)
 
 @router.get("/admin")
-async def admin():
-    return FileResponse(os.path.join(STATIC_DIR, 'admin.html'))
+async def admin(request: Request):
+    return static_assets.page('admin.html', request.headers)
 
 @router.get("/logs")
-async def logs():
-    return FileResponse(os.path.join(STATIC_DIR, 'logs.html'))
+async def logs(request: Request):
+    return static_assets.page('logs.html', request.headers)
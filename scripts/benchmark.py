@@ -0,0 +1,330 @@
+"""In-process load test for the verification API.
+
+Runs the FastAPI app against the in-memory database seeded with a
+deterministic dataset, drives a weighted mix of endpoints at a fixed
+concurrency and writes throughput, latency percentiles and database round
+trips per request to a JSON file.
+
+    python scripts/benchmark.py --requests 5000 --concurrency 32
+    python scripts/benchmark.py --db-latency-ms 5 --compare data/benchmarks/<earlier>.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+import contextvars
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+RESULTS_DIR = os.path.join(ROOT, 'data', 'benchmarks')
+HISTORY_EMPLOYEE = "kimhai1234"
+
+DEFAULT_MIX = "verify=50,label=30,history=10,sync=10"
+
+# Round trips issued while handling the current request; None outside one
+round_trips = contextvars.ContextVar("round_trips", default=None)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--requests", type=int, default=2000, help="measured requests (after warmup)")
+    p.add_argument("--warmup", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--mix", default=DEFAULT_MIX, help=f"weighted workload mix (default {DEFAULT_MIX})")
+    p.add_argument("--employees", type=int, default=300)
+    p.add_argument("--devices", type=int, default=20000)
+    p.add_argument("--labels", type=int, default=20000)
+    p.add_argument("--events", type=int, default=100000)
+    p.add_argument("--sync-batch", type=int, default=50, help="events per offline-sync burst")
+    p.add_argument("--db-latency-ms", type=float, default=0.0, help="simulated database round trip time")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", help="result file (default data/benchmarks/<timestamp>-<commit>.json)")
+    p.add_argument("--compare", help="earlier result file to print deltas against")
+    return p.parse_args(argv)
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in WORKLOADS:
+            raise SystemExit(f"Unknown workload {name!r}; choose from {', '.join(WORKLOADS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def seed_tables(args, rng):
+    employees = [{"employee_code": f"E{i:05d}", "full_name": f"Employee {i}", "password_text": "1234", "is_first_login": False}
+                 for i in range(args.employees)]
+    employees.append({"employee_code": HISTORY_EMPLOYEE, "full_name": "Kim Hai", "password_text": "1234", "is_first_login": False, "role": "auditor"})
+
+    models = ["Infusion Pump", "Ventilator", "Patient Monitor", "Defibrillator", "Syringe Pump", "ECG"]
+    devices = [{"serial_raw": f"SN-{i:07d}", "serial_norm": f"SN-{i:07d}", "model": rng.choice(models),
+                "mfg_date": None, "created_at": "2024-01-01T00:00:00+00:00"}
+               for i in range(args.devices)]
+    labels = [{"label_id": f"L{i:07d}", "bound_serial_norm": devices[i % len(devices)]["serial_norm"], "active": rng.random() > 0.02}
+              for i in range(args.labels)]
+
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+    step = datetime.timedelta(days=365) / max(args.events, 1)
+    events = []
+    for i in range(args.events):
+        label = rng.choice(labels)
+        emp = rng.choice(employees)
+        events.append({
+            "label_id": label["label_id"],
+            "expected_serial_norm": label["bound_serial_norm"],
+            "employee_code": emp["employee_code"],
+            "employee_name": emp["full_name"],
+            "result": "PASS" if label["active"] else "FAIL",
+            "method": "SCAN",
+            "is_offline_event": rng.random() < 0.1,
+            "created_at": (start + step * i).isoformat(),
+        })
+    return {"employees": employees, "devices": devices, "labels": labels, "verification_events": events}
+
+
+class Workload:
+    def __init__(self, rng, tables, sync_batch):
+        import session
+        self.rng = rng
+        self.label_ids = [l["label_id"] for l in tables["labels"]]
+        self.employee_codes = [e["employee_code"] for e in tables["employees"]]
+        # What /api/auth/login would hand each device
+        self.tokens = {
+            e["employee_code"]: session.signer.issue(e["employee_code"], e["full_name"], e.get("role") or session.DEFAULT_ROLE)[0]
+            for e in tables["employees"]
+        }
+        self.sync_batch = sync_batch
+        self.sent_events = []
+
+    def label_id(self):
+        # Skewed towards a hot set, like wards rescanning the same equipment; a few misses
+        if self.rng.random() < 0.03:
+            return f"MISSING-{self.rng.randrange(10 ** 6)}"
+        if self.rng.random() < 0.8:
+            return self.label_ids[int(self.rng.paretovariate(1.2)) % len(self.label_ids)]
+        return self.rng.choice(self.label_ids)
+
+    def auth(self, employee_code):
+        return {"Authorization": f"Bearer {self.tokens[employee_code]}"}
+
+    def verify(self):
+        employee_code = self.rng.choice(self.employee_codes)
+        return "POST", "/api/verify", {"headers": self.auth(employee_code), "json": {
+            "label_id": self.label_id(),
+            "method": "SCAN",
+        }}
+
+    def label(self):
+        return "GET", f"/api/labels/{self.label_id()}", {}
+
+    def history(self):
+        return "GET", "/api/history/grouped", {"headers": self.auth(HISTORY_EMPLOYEE)}
+
+    def sync(self):
+        # Offline queue replay: back-dated events, some already sent by an earlier burst
+        now = datetime.datetime.now(datetime.timezone.utc)
+        employee_code = self.rng.choice(self.employee_codes)
+        events = []
+        for _ in range(self.sync_batch):
+            if self.sent_events and self.rng.random() < 0.1:
+                events.append(self.rng.choice(self.sent_events))
+                continue
+            event = {
+                "id": str(uuid.UUID(int=self.rng.getrandbits(128))),
+                "label_id": self.label_id(),
+                "employee_code": employee_code,
+                "method": "SCAN",
+                "is_offline_event": True,
+                "created_at": (now - datetime.timedelta(minutes=self.rng.randrange(1, 24 * 60))).isoformat(),
+            }
+            self.sent_events.append(event)
+            events.append(event)
+        return "POST", "/api/verify/batch", {"headers": self.auth(employee_code), "json": {"events": events}}
+
+
+WORKLOADS = {"verify": Workload.verify, "label": Workload.label, "history": Workload.history, "sync": Workload.sync}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # Nearest-rank
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(s["ms"] for s in samples)
+    trips = [s["round_trips"] for s in samples]
+    return {
+        "requests": len(samples),
+        # 4xx are expected for part of the mix (unknown labels); 5xx and transport failures are not
+        "client_errors": sum(1 for s in samples if 400 <= s["status"] < 500),
+        "errors": sum(1 for s in samples if s["status"] >= 500),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "db_round_trips": {
+            "mean": round(sum(trips) / len(trips), 2) if trips else None,
+            "max": max(trips) if trips else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args):
+    from database import db, MemoryBackend
+    import main
+
+    rng = random.Random(args.seed)
+    tables = seed_tables(args, rng)
+    backend = MemoryBackend(seed=tables, latency=args.db_latency_ms / 1000)
+    db.backend = backend
+
+    # Counts every query; attributed to the request running in this context, if any
+    background = [0]
+    execute = backend.execute
+
+    async def counted_execute(q):
+        counter = round_trips.get()
+        (counter if counter is not None else background)[0] += 1
+        return await execute(q)
+
+    backend.execute = counted_execute
+
+    import httpx
+    transport = httpx.ASGITransport(app=main.app)
+    started = time.perf_counter()
+    await main.startup()
+    startup_s = time.perf_counter() - started
+    background[0] = 0
+
+    workload = Workload(rng, tables, args.sync_batch)
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    plan = rng.choices(names, weights=weights, k=args.warmup + args.requests)
+
+    samples = []
+    position = 0
+
+    async def one(client, name, record):
+        method, path, kwargs = WORKLOADS[name](workload)
+        counter = [0]
+        token = round_trips.set(counter)
+        t0 = time.perf_counter()
+        try:
+            resp = await client.request(method, path, **kwargs)
+            status = resp.status_code
+        except Exception:
+            status = 599
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            round_trips.reset(token)
+        if record:
+            samples.append({"workload": name, "status": status, "ms": round(ms, 3), "round_trips": counter[0]})
+
+    async def worker(client, stop, record):
+        nonlocal position
+        while position < stop:
+            name = plan[position]
+            position += 1
+            await one(client, name, record)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.gather(*(worker(client, args.warmup, False) for _ in range(args.concurrency)))
+        background[0] = 0
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker(client, args.warmup + args.requests, True) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - t0
+
+    # Drain the write-behind queue so its round trips are part of the report
+    await main.shutdown()
+
+    import audit
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "startup_s": round(startup_s, 3),
+        "elapsed_s": round(elapsed, 3),
+        "overall": summarize(samples, elapsed),
+        "workloads": {name: summarize([s for s in samples if s["workload"] == name], elapsed) for name in names},
+        "background_db_round_trips": background[0],
+        "audit": audit.writer.stats(),
+    }
+
+
+def print_report(result, baseline=None):
+    def row(name, s, base):
+        lat = s["latency_ms"]
+        line = (f"{name:<10} {s['requests']:>7} {s['errors']:>6} {s['throughput_rps'] or 0:>9.1f} "
+                f"{lat['p50'] or 0:>8.2f} {lat['p95'] or 0:>8.2f} {lat['p99'] or 0:>8.2f} {s['db_round_trips']['mean'] or 0:>7.2f}")
+        if base and base.get("latency_ms", {}).get("p95"):
+            line += f"   p95 {(lat['p95'] - base['latency_ms']['p95']) / base['latency_ms']['p95'] * 100:+.1f}%"
+            line += f"  rps {((s['throughput_rps'] or 0) - base['throughput_rps']) / base['throughput_rps'] * 100:+.1f}%"
+        print(line)
+
+    print(f"commit {result['commit']}  concurrency {result['config']['concurrency']}  "
+          f"db latency {result['config']['db_latency_ms']}ms  elapsed {result['elapsed_s']}s")
+    print(f"{'workload':<10} {'reqs':>7} {'errors':>6} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/req':>7}")
+    for name, s in result["workloads"].items():
+        row(name, s, (baseline or {}).get("workloads", {}).get(name))
+    row("overall", result["overall"], (baseline or {}).get("overall"))
+    print(f"background db round trips (audit flushes): {result['background_db_round_trips']}")
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    sys.path.insert(0, ROOT)
+    os.chdir(ROOT)
+    # Must be set before the app modules are imported
+    os.environ["DB_BACKEND"] = "memory"
+    os.environ.setdefault("ADMIN_PIN", "benchmark")
+    os.environ.setdefault("AUDIT_JOURNAL_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-audit-"), "journal.jsonl"))
+    os.environ.setdefault("PHOTO_DIR", tempfile.mkdtemp(prefix="bench-photos-"))
+    os.environ.setdefault("LABEL_TABLE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-labels-"), "label_table.bin"))
+
+    result = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit'] or 'nogit'}.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,187 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import posixpath
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), '..', 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_NAME = 'asset-manifest.json'
+
+# Served under a stable URL: pages are entry points and the service worker must keep its URL
+UNHASHED = {'index.html', 'admin.html', 'logs.html', 'js/sw.js'}
+# Third-party bundles are copied byte-for-byte, never rewritten
+VENDOR_PREFIX = 'vendor/'
+REWRITE_EXTENSIONS = {'.html', '.js', '.css'}
+COMPRESS_EXTENSIONS = {'.html', '.js', '.css', '.json', '.svg', '.txt', '.wasm', '.map'}
+# Only keep a compressed variant when it saves at least this much
+MIN_SAVING = 0.9
+
+# "/static/x" anywhere, or "./x" / "../x" module specifiers, inside quotes or url()
+REFERENCE = re.compile(r'''(["'(])(/static/[^"'()?#\s]+|\.\.?/[^"'()?#\s]+)(?=["')?#])''')
+SW_MANIFEST = re.compile(r'const ASSET_MANIFEST = \{.*?\n\};', re.S)
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def hashed_name(path, digest):
+    root, ext = posixpath.splitext(path)
+    return f"{root}.{digest[:10]}{ext}"
+
+
+def collect(static_dir):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        rel_dir = os.path.relpath(dirpath, static_dir).replace(os.sep, '/')
+        if rel_dir == 'dist' or rel_dir.startswith('dist/'):
+            dirnames[:] = []
+            continue
+        for name in filenames:
+            rel = name if rel_dir == '.' else f"{rel_dir}/{name}"
+            with open(os.path.join(dirpath, name), 'rb') as f:
+                files[rel] = f.read()
+    return files
+
+
+def resolve(ref, source):
+    if ref.startswith('/static/'):
+        return ref[len('/static/'):]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source), ref))
+
+
+class AssetBuilder:
+    """Builds static/dist: rewritten references, content-hashed names, .gz/.br variants.
+
+    Text files are built after the files they reference, so a change to
+    db.js also renames app.js, which imports it. Unchanged files keep their
+    names between builds and stay cached by browsers and the service worker.
+    """
+
+    def __init__(self, static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+        self.static_dir = static_dir
+        self.dist_dir = dist_dir
+        self.sources = collect(static_dir)
+        self.built = {}     # logical path -> output path
+        self.building = set()
+        self.manifest = {}  # URL path under /static -> entry
+
+    def build(self):
+        for path in sorted(self.sources):
+            if path != 'js/sw.js':
+                self._build(path)
+        # Last, so it lists every other asset
+        if 'js/sw.js' in self.sources:
+            self._build('js/sw.js')
+        version = content_hash(json.dumps(self.manifest, sort_keys=True).encode())
+        self._write(MANIFEST_NAME, json.dumps({"version": version, "files": self.manifest}, indent=2, sort_keys=True).encode())
+        return self.manifest
+
+    def _build(self, path):
+        if path in self.built:
+            return self.built[path]
+        if path in self.building:
+            raise ValueError(f"Circular reference through {path}")
+        self.building.add(path)
+
+        data = self.sources[path]
+        ext = posixpath.splitext(path)[1]
+        if path == 'js/sw.js':
+            data = self._service_worker(data)
+        elif ext in REWRITE_EXTENSIONS and not path.startswith(VENDOR_PREFIX):
+            data = self._rewrite(path, data)
+
+        digest = content_hash(data)
+        out = path if path in UNHASHED else hashed_name(path, digest)
+        encodings = self._write(out, data, compress=ext in COMPRESS_EXTENSIONS)
+
+        entry = {"file": out, "etag": digest, "encodings": encodings}
+        self.manifest[path] = dict(entry, immutable=False)
+        if out != path:
+            self.manifest[out] = dict(entry, immutable=True)
+        self.built[path] = out
+        self.building.discard(path)
+        return out
+
+    def _rewrite(self, path, data):
+        text = data.decode('utf-8')
+
+        def replace(m):
+            quote, ref = m.groups()
+            target = resolve(ref, path)
+            if target not in self.sources or target in UNHASHED:
+                return m.group(0)
+            out = self._build(target)
+            if ref.startswith('/static/'):
+                return f"{quote}/static/{out}"
+            rel = posixpath.relpath(out, posixpath.dirname(path))
+            return f"{quote}{rel if rel.startswith('.') else './' + rel}"
+
+        return REFERENCE.sub(replace, text).encode('utf-8')
+
+    def _service_worker(self, data):
+        pages = ['/' + p[:-len('.html')] for p in sorted(self.manifest) if p in UNHASHED and p.endswith('.html')]
+        pages = ['/' if p == '/index' else p for p in pages]
+        # Logical URL -> hashed URL for everything else that has been built
+        assets = {f"/static/{p}": f"/static/{e['file']}" for p, e in sorted(self.manifest.items()) if not e["immutable"] and p not in UNHASHED}
+        version = content_hash(json.dumps(assets, sort_keys=True).encode())
+        block = "const ASSET_MANIFEST = " + json.dumps({"version": version, "pages": pages, "assets": assets}, indent=4) + ";"
+        text, n = SW_MANIFEST.subn(lambda m: block, data.decode('utf-8'), count=1)
+        if not n:
+            raise ValueError("js/sw.js has no ASSET_MANIFEST block to replace")
+        return text.encode('utf-8')
+
+    def _write(self, rel, data, compress=False):
+        dest = os.path.join(self.dist_dir, *rel.split('/'))
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'wb') as f:
+            f.write(data)
+        encodings = []
+        if not compress:
+            return encodings
+        variants = [("gzip", ".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.insert(0, ("br", ".br", lambda d: brotli.compress(d, quality=11)))
+        for name, suffix, fn in variants:
+            packed = fn(data)
+            if len(packed) <= len(data) * MIN_SAVING:
+                with open(dest + suffix, 'wb') as f:
+                    f.write(packed)
+                encodings.append(name)
+            elif os.path.exists(dest + suffix):
+                os.remove(dest + suffix)
+        return encodings
+
+
+def prune(dist_dir, manifest):
+    # Drops outputs of earlier builds that no file maps to anymore
+    keep = {MANIFEST_NAME}
+    for entry in manifest.values():
+        keep.add(entry["file"])
+        keep.update(entry["file"] + s for s in (".gz", ".br"))
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(dist_dir):
+        for name in filenames:
+            rel = os.path.relpath(os.path.join(dirpath, name), dist_dir).replace(os.sep, '/')
+            if rel not in keep:
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    builder = AssetBuilder()
+    manifest = builder.build()
+    removed = prune(DIST_DIR, manifest)
+    built = {e["file"] for e in manifest.values()}
+    compressed = sum(1 for e in manifest.values() if e["encodings"] and not e["immutable"])
+    print(f"Built {len(built)} assets into {os.path.normpath(DIST_DIR)} ({compressed} precompressed, {removed} stale files removed)")
+    if brotli is None:
+        print("brotli not installed; only gzip variants were written")
@@ -0,0 +1,209 @@
+import os
+import asyncio
+import datetime
+import itertools
+from collections import Counter, defaultdict
+from database import db
+from utils import normalize_serial
+
+# Past two edits a short serial shares no grams with the query and nearly every device becomes a candidate
+MAX_DISTANCE_LIMIT = 2
+MAX_DISTANCE = min(float(os.environ.get("SERIAL_MATCH_MAX_DISTANCE", 2)), MAX_DISTANCE_LIMIT)
+# Cost of substituting characters OCR commonly mixes up, vs 1 for any other edit
+CONFUSION_COST = 0.25
+# Trigrams prune best; bigrams keep a positive bound for serials too short for trigrams
+GRAM_SIZES = (3, 2)
+# Most candidates scored per query, those sharing the most grams with it first
+MAX_CANDIDATES = 500
+
+# OCR look-alikes; each group collapses to its first character in the canonical form
+CONFUSION_GROUPS = ["0ODQ", "1IL|", "5S", "8B", "2Z", "6G", "UV"]
+CANONICAL = {c: group[0] for group in CONFUSION_GROUPS for c in group}
+# Separators OCR tends to drop or invent
+SEPARATORS = set(" -_/.:")
+PAGE_SIZE = 1000
+# sync() re-reads devices created this long before the previous sync started, for
+# inserts committed late and clock differences between app hosts
+SYNC_OVERLAP = datetime.timedelta(seconds=60)
+
+
+def strip_separators(s):
+    return "".join(c for c in s if c not in SEPARATORS)
+
+
+def canonical(s):
+    return "".join(CANONICAL.get(c, c) for c in strip_separators(s))
+
+
+def grams(key, q=3):
+    padded = "^" + key + "$"
+    return {padded[i:i + q] for i in range(len(padded) - q + 1)}
+
+
+def sub_cost(a, b):
+    if a == b:
+        return 0.0
+    if CANONICAL.get(a, a) == CANONICAL.get(b, b):
+        return CONFUSION_COST
+    return 1.0
+
+
+def ocr_distance(a, b, max_distance=MAX_DISTANCE):
+    """Weighted Levenshtein distance with cheap look-alike substitutions.
+
+    Gives up early and returns None once every alignment exceeds max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    prev = [float(j) for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        cur = [float(i)] + [0.0] * len(b)
+        for j in range(1, len(b) + 1):
+            cur[j] = min(
+                prev[j] + 1,
+                cur[j - 1] + 1,
+                prev[j - 1] + sub_cost(a[i - 1], b[j - 1]),
+            )
+        if min(cur) > max_distance:
+            return None
+        prev = cur
+    return prev[-1] if prev[-1] <= max_distance else None
+
+
+def score(query, serials, max_distance, limit):
+    # Pure Python and CPU-bound: SerialIndex.match runs it in the executor
+    results = []
+    for serial_norm in serials:
+        d = ocr_distance(query, strip_separators(serial_norm), max_distance)
+        if d is not None:
+            results.append({"serial_norm": serial_norm, "distance": round(d, 2)})
+    results.sort(key=lambda r: (r["distance"], r["serial_norm"]))
+    return results[:limit]
+
+
+class SerialIndex:
+    """In-memory fuzzy index over devices.serial_norm for OCR'd serials.
+
+    Serials are indexed by trigrams and bigrams of their canonical form
+    (look-alikes folded, separators dropped), so a confusable substitution
+    doesn't cost a gram. A candidate within k plain edits shares at least
+    grams - q*k q-grams with the query; the longest q keeping that bound
+    positive picks the candidates, and only the MAX_CANDIDATES sharing the
+    most grams get the exact weighted distance computed, off the event loop.
+    Devices created by other worker processes are picked up by sync(), which
+    polls devices by created_at (stamped by the app as naive local time).
+    """
+
+    def __init__(self):
+        self.serials = []                  # id -> serial_norm (None once removed)
+        self.ids = {}                      # serial_norm -> id
+        self.by_canonical = defaultdict(set)
+        self.by_gram = {q: defaultdict(set) for q in GRAM_SIZES}
+        self.by_length = defaultdict(set)  # canonical length -> ids, for queries too short to prune by grams
+        self.loaded = False
+        self.loading = None
+        self.synced_at = None              # when the build or previous sync started
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, serial_norm):
+        if not serial_norm or serial_norm in self.ids:
+            return
+        i = len(self.serials)
+        self.serials.append(serial_norm)
+        self.ids[serial_norm] = i
+        key = canonical(serial_norm)
+        self.by_canonical[key].add(i)
+        self.by_length[len(key)].add(i)
+        for q, by_gram in self.by_gram.items():
+            for g in grams(key, q):
+                by_gram[g].add(i)
+
+    def remove(self, serial_norm):
+        i = self.ids.pop(serial_norm, None)
+        if i is None:
+            return
+        self.serials[i] = None
+        key = canonical(serial_norm)
+        self.by_canonical[key].discard(i)
+        self.by_length[len(key)].discard(i)
+        for q, by_gram in self.by_gram.items():
+            for g in grams(key, q):
+                by_gram[g].discard(i)
+
+    def _candidates(self, key, max_edits):
+        for q in GRAM_SIZES:
+            query_grams = grams(key, q)
+            need = len(query_grams) - q * max_edits
+            if need > 0:
+                counts = Counter()
+                for g in query_grams:
+                    counts.update(self.by_gram[q].get(g, ()))
+                close = itertools.takewhile(lambda ic: ic[1] >= need, counts.most_common())
+                return [i for i, _ in itertools.islice(close, MAX_CANDIDATES)]
+        # Only a few characters long: similar lengths, nearest first
+        out = []
+        for n in sorted(range(len(key) - max_edits, len(key) + max_edits + 1), key=lambda n: abs(n - len(key))):
+            out.extend(itertools.islice(self.by_length.get(n, ()), MAX_CANDIDATES - len(out)))
+        return out
+
+    async def match(self, observed, max_distance=MAX_DISTANCE, limit=5):
+        query = strip_separators(normalize_serial(observed))
+        if not query:
+            return []
+        max_distance = min(max_distance, MAX_DISTANCE_LIMIT)
+        key = canonical(query)
+        ids = dict.fromkeys(itertools.chain(self.by_canonical.get(key, ()), self._candidates(key, int(max_distance))))
+        serials = [s for s in (self.serials[i] for i in ids) if s is not None]
+        return await asyncio.get_running_loop().run_in_executor(None, score, query, serials, max_distance, limit)
+
+    async def load(self):
+        if self.loaded:
+            return
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(self._load())
+        try:
+            await asyncio.shield(self.loading)
+        finally:
+            if self.loading is not None and self.loading.done():
+                self.loading = None
+
+    async def _load(self):
+        started = datetime.datetime.now()
+        # Keyset walk over devices so the build never pulls the whole table in one response
+        last = None
+        while True:
+            q = db.table("devices").select("serial_norm").order("serial_norm").limit(PAGE_SIZE)
+            if last is not None:
+                q = q.gt("serial_norm", last)
+            res = await q.execute()
+            for r in res.data:
+                self.add(r['serial_norm'])
+            if len(res.data) < PAGE_SIZE:
+                break
+            last = res.data[-1]['serial_norm']
+        self.synced_at = started
+        self.loaded = True
+
+    async def sync(self):
+        # Devices other workers created; add() skips the ones already indexed
+        if not self.loaded:
+            return
+        started = datetime.datetime.now()
+        since = (self.synced_at - SYNC_OVERLAP).isoformat()
+        last = None
+        while True:
+            q = db.table("devices").select("serial_norm, created_at").gte("created_at", since)
+            if last is not None:
+                q = q.or_(("created_at", "gt", last["created_at"]), [("created_at", "eq", last["created_at"]), ("serial_norm", "gt", last["serial_norm"])])
+            res = await q.order("created_at").order("serial_norm").limit(PAGE_SIZE).execute()
+            for r in res.data:
+                self.add(r['serial_norm'])
+            if len(res.data) < PAGE_SIZE:
+                break
+            last = res.data[-1]
+        self.synced_at = started
+
+
+serial_index = SerialIndex()
@@ -0,0 +1,161 @@
+"""Production launcher: pre-fork workers sharing one listening socket.
+
+    WEB_CONCURRENCY=4 python serve.py
+
+The app is imported and the label table snapshot built and mapped once in
+the master, then inherited by each forked worker, so workers start without
+rebuilding anything and share the table's pages. Device history and the
+serial index are per worker and poll the database for the others' writes
+(SHARED_STATE_REFRESH); metrics are summed over the workers through
+METRICS_DIR, so any worker answers /metrics for the whole server. SIGTERM/SIGINT drains
+workers: /ready turns 503, in-flight requests finish, the audit queue is
+flushed, and whatever is still running after GRACEFUL_TIMEOUT is killed.
+"""
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import uvicorn
+
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8000))
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 2))
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+# A worker dying sooner than this after start is treated as a crash loop and restarted with a delay
+MIN_UPTIME = 5
+
+# Preload: everything imported here is shared copy-on-write with the workers
+import main
+import metrics
+from database import db
+from label_table import label_table
+
+
+class WorkerServer(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        # Fail readiness first so the load balancer stops routing here while we drain
+        main.app.state.draining = True
+        super().handle_exit(sig, frame)
+
+
+def prepare():
+    async def build():
+        try:
+            await label_table.load()
+        finally:
+            # The client would be bound to this short-lived loop; workers open their own
+            await label_table.stop()
+            await db.close()
+
+    try:
+        asyncio.run(build())
+    except Exception as e:
+        print(f"Label table build failed, workers will retry: {e}")
+
+
+def run_worker(sock):
+    # Own process group: a terminal Ctrl-C reaches the master only, which drains workers once
+    os.setpgid(0, 0)
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    config = uvicorn.Config(
+        main.app,
+        lifespan="on",
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        proxy_headers=True,
+        forwarded_allow_ips="*",
+    )
+    WorkerServer(config).run(sockets=[sock])
+    os._exit(0)
+
+
+def serve():
+    if not hasattr(os, "fork"):
+        sys.exit("serve.py needs fork(); use `python main.py` on this platform")
+    if WORKERS > 1 and db.backend.__class__.__name__ == "MemoryBackend":
+        print("Warning: in-memory database with several workers; each worker has its own copy.")
+
+    sock = socket.socket(socket.AF_INET6 if ":" in HOST else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    if WORKERS > 1:
+        # Snapshots from a previous run would be counted as exited workers
+        os.makedirs(metrics.SHARED_DIR, exist_ok=True)
+        for name in os.listdir(metrics.SHARED_DIR):
+            os.remove(os.path.join(metrics.SHARED_DIR, name))
+        metrics.registry.shared_dir = metrics.SHARED_DIR
+
+    started = time.monotonic()
+    prepare()
+    print(f"Prepared in {time.monotonic() - started:.2f}s; starting {WORKERS} workers on {HOST}:{PORT}")
+
+    workers = {}  # pid -> start time
+    stopping = False
+    deadline = None
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            run_worker(sock)
+        workers[pid] = time.monotonic()
+
+    def on_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    for _ in range(WORKERS):
+        spawn()
+
+    while workers:
+        if stopping and deadline is None:
+            print(f"Draining {len(workers)} workers (up to {GRACEFUL_TIMEOUT:.0f}s)")
+            deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+            for pid in workers:
+                _signal(pid, signal.SIGTERM)
+        if deadline is not None and time.monotonic() > deadline:
+            for pid in workers:
+                _signal(pid, signal.SIGKILL)
+            deadline = float("inf")
+
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        began = workers.pop(pid, None)
+        if began is None or stopping:
+            continue
+        print(f"Worker {pid} exited ({_describe(status)}); restarting")
+        if time.monotonic() - began < MIN_UPTIME:
+            time.sleep(1)
+        spawn()
+
+    sock.close()
+    print("All workers stopped")
+
+
+def _signal(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _describe(status):
+    if os.WIFSIGNALED(status):
+        return f"signal {os.WTERMSIG(status)}"
+    return f"status {os.WEXITSTATUS(status)}"
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,134 @@
+import os
+import time
+import hmac
+import json
+import base64
+import hashlib
+import secrets
+from fastapi import Header, HTTPException, Depends
+
+TTL = int(os.environ.get("SESSION_TTL", 12 * 3600))  # one shift
+# How long after expiry a session token still vouches for the offline scans queued under it
+QUEUE_GRACE = int(os.environ.get("SESSION_QUEUE_GRACE", 7 * 24 * 3600))
+# Allowed to read verification history (replaces the hardcoded employee check)
+HISTORY_ROLES = {"auditor", "admin"}
+DEFAULT_ROLE = "staff"
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def load_keys(spec=None):
+    """SESSION_KEYS="kid:secret,kid:secret": the first key signs, all of them verify.
+
+    Rotating is prepending a new key and dropping the oldest once TTL has passed.
+    """
+    spec = spec if spec is not None else os.environ.get("SESSION_KEYS", "")
+    keys = []
+    for part in spec.split(","):
+        kid, sep, secret = part.strip().partition(":")
+        if not sep or not kid or not secret:
+            continue
+        keys.append((kid, secret.encode()))
+    if not keys:
+        # Tokens won't survive a restart, and each process would need the same key
+        print("Warning: SESSION_KEYS not set. Using an ephemeral session signing key.")
+        keys.append(("ephemeral", secrets.token_bytes(32)))
+    return keys
+
+
+class TokenSigner:
+    """Stateless HS256 JWTs carrying the employee code, display name and role.
+
+    Verification is an HMAC over the token, so authenticated requests don't
+    touch the employees table.
+    """
+
+    def __init__(self, keys, ttl=TTL):
+        self.keys = dict(keys)
+        self.signing_kid = keys[0][0]
+        self.ttl = ttl
+
+    def _sign(self, kid, signing_input):
+        return hmac.new(self.keys[kid], signing_input, hashlib.sha256).digest()
+
+    def issue(self, employee_code, name, role, now=None):
+        now = int(now if now is not None else time.time())
+        header = {"alg": "HS256", "typ": "JWT", "kid": self.signing_kid}
+        claims = {"sub": employee_code, "name": name, "role": role, "iat": now, "exp": now + self.ttl}
+        signing_input = (
+            _b64encode(json.dumps(header, separators=(",", ":")).encode())
+            + "."
+            + _b64encode(json.dumps(claims, separators=(",", ":"), ensure_ascii=False).encode())
+        ).encode("ascii")
+        return signing_input.decode("ascii") + "." + _b64encode(self._sign(self.signing_kid, signing_input)), claims
+
+    def verify(self, token, now=None, leeway=0):
+        try:
+            header_b64, claims_b64, sig_b64 = token.split(".")
+            header = json.loads(_b64decode(header_b64))
+            signature = _b64decode(sig_b64)
+        except (ValueError, TypeError):
+            raise InvalidToken("Malformed session token")
+        if not isinstance(header, dict) or header.get("alg") != "HS256" or header.get("kid") not in self.keys:
+            raise InvalidToken("Unknown session signing key")
+        expected = self._sign(header["kid"], f"{header_b64}.{claims_b64}".encode("ascii"))
+        if not hmac.compare_digest(signature, expected):
+            raise InvalidToken("Invalid session token signature")
+        try:
+            claims = json.loads(_b64decode(claims_b64))
+        except ValueError:
+            raise InvalidToken("Malformed session token")
+        if not isinstance(claims, dict) or not claims.get("sub"):
+            raise InvalidToken("Malformed session token")
+        if claims.get("exp", 0) + leeway <= (now if now is not None else time.time()):
+            raise InvalidToken("Session expired, please log in again")
+        return claims
+
+
+signer = TokenSigner(load_keys())
+
+
+def _bearer(authorization):
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def queued_claims(token, employee_code):
+    """Claims of the session an offline event was queued under, or None unless it was employee_code's."""
+    if not token:
+        return None
+    try:
+        claims = signer.verify(token, leeway=QUEUE_GRACE)
+    except InvalidToken:
+        return None
+    return claims if claims["sub"] == employee_code else None
+
+
+def require_session(authorization: str = Header(None)):
+    token = _bearer(authorization)
+    if token is None:
+        raise HTTPException(status_code=401, detail="Login required", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return signer.verify(token)
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"})
+
+
+def require_history_role(session: dict = Depends(require_session)):
+    if session.get("role") not in HISTORY_ROLES:
+        raise HTTPException(status_code=403, detail="Access denied. Your role cannot view history.")
+    return session
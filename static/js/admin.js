@@ -48,40 +48,69 @@ els.authBtn.addEventListener('click', async () => {
 });
 
 // Mapping Management
+// Only the current page is fetched; searching, sorting and paging are done by the server
+const PAGE_SIZE = 50;
+const mappingEls = {
+    search: document.getElementById('mapping-search'),
+    field: document.getElementById('mapping-field'),
+    match: document.getElementById('mapping-match'),
+    prev: document.getElementById('mapping-prev'),
+    next: document.getElementById('mapping-next'),
+    info: document.getElementById('mapping-page-info')
+};
+const mappingQuery = { offset: 0, sort: 'label_id', desc: false };
+let mappingRequest = 0;
+
 async function loadMappings() {
     const tbody = document.getElementById('mapping-list-body');
     tbody.innerHTML = '<tr><td colspan="4">Loading...</td></tr>';
 
-    const data = await apiCall('/api/admin/mappings', 'GET');
+    const params = new URLSearchParams({
+        offset: mappingQuery.offset,
+        limit: PAGE_SIZE,
+        sort: mappingQuery.sort,
+        desc: mappingQuery.desc,
+        match: mappingEls.match.value
+    });
+    const q = mappingEls.search.value.trim();
+    if (q) params.set('q', q);
+    if (mappingEls.field.value) params.set('field', mappingEls.field.value);
+
+    // Ignore responses that arrive after a newer search was started
+    const request = ++mappingRequest;
+    const data = await apiCall(`/api/admin/mappings?${params}`, 'GET');
+    if (request !== mappingRequest) return;
     if (!data) {
         tbody.innerHTML = '<tr><td colspan="4">Error loading data</td></tr>';
         return;
     }
+    if (data.items.length === 0 && data.offset > 0 && data.total > 0) {
+        // The page emptied out (e.g. its last mapping was deleted): show the last one instead
+        mappingQuery.offset = Math.max(0, Math.floor((data.total - 1) / PAGE_SIZE) * PAGE_SIZE);
+        return loadMappings();
+    }
+
+    const first = data.total ? data.offset + 1 : 0;
+    const last = data.offset + data.items.length;
+    mappingEls.info.innerText = `${first}–${last} / ${data.total}`;
+    mappingEls.prev.disabled = data.offset === 0;
+    mappingEls.next.disabled = last >= data.total;
 
     tbody.innerHTML = '';
-    if (data.length === 0) {
-        tbody.innerHTML = '<tr><td colspan="4">Chưa có liên kết nào</td></tr>';
+    if (data.items.length === 0) {
+        tbody.innerHTML = `<tr><td colspan="4">${q ? 'Không tìm thấy liên kết nào' : 'Chưa có liên kết nào'}</td></tr>`;
         return;
     }
 
-    data.forEach(item => {
+    data.items.forEach(item => {
         const tr = document.createElement('tr');
 
-        // Extract device info (it might be a list or object depending on Supabase join result)
-        // With select=...,devices(*), devices is usually an object (if 1-to-1) or array?
-        // Let's assume 1-to-1 and it returns an object or null since bound_serial_norm is FK.
-        // PostgREST with standard relationship: devices: { ... }
-
         let model = "N/A";
         let serial = "N/A";
 
         if (item.devices) {
-            // If multiple match (shouldn't be), take first
-            const dev = Array.isArray(item.devices) ? item.devices[0] : item.devices;
-            if (dev) {
-                model = dev.model || "";
-                serial = dev.serial_raw || "";
-            }
+            model = item.devices.model || "";
+            serial = item.devices.serial_raw || "";
         }
 
         tr.innerHTML = `
@@ -96,6 +125,41 @@ async function loadMappings() {
     });
 }
 
+function reloadMappingsFromStart() {
+    mappingQuery.offset = 0;
+    loadMappings();
+}
+
+let searchTimer = null;
+mappingEls.search.addEventListener('input', () => {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(reloadMappingsFromStart, 250);
+});
+mappingEls.field.addEventListener('change', reloadMappingsFromStart);
+mappingEls.match.addEventListener('change', reloadMappingsFromStart);
+
+mappingEls.prev.addEventListener('click', () => {
+    mappingQuery.offset = Math.max(0, mappingQuery.offset - PAGE_SIZE);
+    loadMappings();
+});
+mappingEls.next.addEventListener('click', () => {
+    mappingQuery.offset += PAGE_SIZE;
+    loadMappings();
+});
+
+document.querySelectorAll('#mapping-table th[data-sort]').forEach(th => {
+    th.addEventListener('click', () => {
+        // Clicking the current sort column flips the direction
+        if (mappingQuery.sort === th.dataset.sort) {
+            mappingQuery.desc = !mappingQuery.desc;
+        } else {
+            mappingQuery.sort = th.dataset.sort;
+            mappingQuery.desc = false;
+        }
+        reloadMappingsFromStart();
+    });
+});
+
 window.deleteMapping = async (labelId) => {
     if (!confirm(`Bạn có chắc muốn xóa liên kết cho ${labelId}?`)) return;
 
@@ -162,6 +226,46 @@ els.bindBtn.addEventListener('click', async () => {
     }
 });
 
+// Bulk Import
+const importEls = {
+    file: document.getElementById('import-file'),
+    rebind: document.getElementById('import-rebind'),
+    btn: document.getElementById('import-btn'),
+    result: document.getElementById('import-result')
+};
+
+importEls.btn.addEventListener('click', async () => {
+    const file = importEls.file.files[0];
+    if (!file) return alert("Chọn file để nhập");
+
+    const format = /\.(ndjson|jsonl)$/i.test(file.name) ? 'ndjson' : 'csv';
+    importEls.btn.disabled = true;
+    importEls.result.classList.remove('hidden');
+    importEls.result.innerText = 'Đang nhập...';
+
+    try {
+        // The File is sent as the raw body, the server reads it as a stream
+        const res = await fetch(`/api/devices/import?format=${format}&rebind=${importEls.rebind.checked}`, {
+            method: 'POST',
+            headers: { 'X-Admin-Pin': pin },
+            body: file
+        });
+        const data = await res.json();
+        if (!res.ok) throw new Error(data.detail || "Import failed");
+
+        let text = `Dòng: ${data.rows}\nThiết bị mới: ${data.devices_created}\nThiết bị đã có: ${data.devices_existing}\nNhãn đã liên kết: ${data.labels_bound}\nLỗi: ${data.error_count}`;
+        data.errors.forEach(e => {
+            text += `\n  Dòng ${e.row} (${e.serial_raw || ''}): ${e.error}`;
+        });
+        importEls.result.innerText = text;
+        loadMappings();
+    } catch (e) {
+        importEls.result.innerText = e.message;
+    } finally {
+        importEls.btn.disabled = false;
+    }
+});
+
 // Scan Helper
 let scanner = null;
 els.scanBtn.addEventListener('click', () => {
@@ -13,6 +13,7 @@ let state = {
     labelId: null,
     employeeCode: localStorage.getItem('employeeCode') || null,
     employeeName: localStorage.getItem('employeeName') || null,
+    sessionToken: localStorage.getItem('sessionToken') || null,
     pendingTarget: null
 };
 
@@ -22,7 +23,7 @@ async function init() {
 
     // Register Service Worker
     if ('serviceWorker' in navigator) {
-        navigator.serviceWorker.register('/static/js/sw.js')
+        navigator.serviceWorker.register('/static/js/sw.js', { scope: '/' })
             .then(reg => console.log('SW registered', reg))
             .catch(err => console.log('SW failed', err));
     }
@@ -30,8 +31,10 @@ async function init() {
     // Sync if online
     if (navigator.onLine) {
         syncEvents();
+        syncLabels();
     }
     window.addEventListener('online', syncEvents);
+    window.addEventListener('online', syncLabels);
 
     // Check for Deep Link (Secure QR)
     const urlParams = new URLSearchParams(window.location.search);
@@ -41,8 +44,8 @@ async function init() {
         state.pendingTarget = target;
     }
 
-    // Auth Check
-    if (state.employeeCode) {
+    // Auth Check (sessions from before tokens existed have to log in again)
+    if (state.employeeCode && state.sessionToken) {
         showUser(state.employeeName);
 
         // If we have a pending target, process it immediately instead of showing scan
@@ -94,11 +97,19 @@ function showUser(name) {
 function handleLogout() {
     localStorage.removeItem('employeeCode');
     localStorage.removeItem('employeeName');
+    localStorage.removeItem('sessionToken');
     state.employeeCode = null;
     state.employeeName = null;
+    state.sessionToken = null;
     location.reload();
 }
 
+function authHeaders() {
+    const headers = { 'Content-Type': 'application/json' };
+    if (state.sessionToken) headers['Authorization'] = `Bearer ${state.sessionToken}`;
+    return headers;
+}
+
 async function handleLogin() {
     const code = document.getElementById('employee-code').value.trim();
     const pass = document.getElementById('employee-password').value.trim();
@@ -126,11 +137,15 @@ async function handleLogin() {
         // Save State
         state.employeeCode = data.employee_code;
         state.employeeName = data.full_name;
+        state.sessionToken = data.token;
 
         // Don't persist if forced to change pass immediately? 
         // Actually we can persist, but UI will force change.
         localStorage.setItem('employeeCode', data.employee_code);
         localStorage.setItem('employeeName', data.full_name);
+        localStorage.setItem('sessionToken', data.token);
+        // Scans queued while logged out were waiting for a session
+        if (navigator.onLine) syncEvents();
 
         if (data.is_first_login) {
             showSection('changePassword');
@@ -281,11 +296,13 @@ async function logUrlAccess(url) {
 
     try {
         if (navigator.onLine) {
-            await fetch('/api/verify', {
+            const resp = await fetch('/api/verify', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: authHeaders(),
                 body: JSON.stringify(payload)
             });
+            // Expired session: queue the event; it syncs once this employee logs in again
+            if (resp.status === 401) await offlineVerify(payload);
         } else {
             await offlineVerify(payload); // Queue it
         }
@@ -309,9 +326,16 @@ async function performVerification() {
         try {
             const resp = await fetch('/api/verify', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
+                headers: authHeaders(),
                 body: JSON.stringify(payload)
             });
+            if (resp.status === 401) {
+                // Session expired mid-shift: queue the scan, then ask for a fresh login
+                await offlineVerify(payload);
+                alert("Phiên đăng nhập đã hết hạn. Lượt quét đã được lưu, vui lòng đăng nhập lại.");
+                handleLogout();
+                return;
+            }
             result = await resp.json();
         } catch (e) {
             // Fallback to offline logic
@@ -339,8 +363,10 @@ async function offlineVerify(payload) {
         message = "Offline: Label not in cache - Queued for server check";
     }
 
-    // Queue event
+    // Queue event, with the session it was scanned under: whoever is logged in when it
+    // syncs can only submit someone else's scans with their token
     payload.result = resultStatus;
+    payload.session_token = state.sessionToken;
 
     await db.queueEvent(payload);
 
@@ -394,27 +420,76 @@ function isValidUrl(string) {
 }
 
 // Sync Logic
+const SYNC_CHUNK_SIZE = 100;
+let syncing = false;
+
 async function syncEvents() {
-    const events = await db.getAllEvents();
-    if (events.length === 0) return;
+    // 'online' can fire while a previous sync is still draining; the batch needs a login
+    if (syncing || !state.sessionToken) return;
+    syncing = true;
 
-    console.log(`Syncing ${events.length} events...`);
+    try {
+        // Quarantined scans (their session had expired) wait for their own employee's next
+        // login, then go out re-signed with that session
+        const events = (await db.getAllEvents())
+            .filter(e => !e.quarantined || e.employee_code === state.employeeCode)
+            .map(e => e.employee_code === state.employeeCode ? { ...e, session_token: state.sessionToken } : e);
+        if (events.length === 0) return;
 
-    for (const event of events) {
-        try {
-            const { id, ...payload } = event;
+        console.log(`Syncing ${events.length} events...`);
+
+        for (let i = 0; i < events.length; i += SYNC_CHUNK_SIZE) {
+            const chunk = events.slice(i, i + SYNC_CHUNK_SIZE);
 
-            await fetch('/api/verify', {
+            const res = await fetch('/api/verify/batch', {
                 method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(payload)
+                headers: authHeaders(),
+                body: JSON.stringify({ events: chunk })
             });
 
-            // Remove from queue on success
-            await db.clearEvent(id);
-        } catch (e) {
-            console.error("Sync failed for event", id, e);
+            if (!res.ok) {
+                console.error("Sync batch failed", res.status);
+                return; // Keep the rest queued, retry on next sync
+            }
+
+            const data = await res.json();
+
+            // Stored now, stored by an earlier replay, or never storable: all done on our side.
+            // Entries the server couldn't read an id from come back by position in the chunk.
+            const doneIds = data.results
+                .filter(r => ['created', 'duplicate', 'invalid'].includes(r.status))
+                .map(r => r.id ?? chunk[r.index]?.id)
+                .filter(id => id !== undefined && id !== null);
+            const unauthorizedIds = data.results
+                .filter(r => r.status === 'unauthorized')
+                .map(r => r.id);
+
+            await db.clearEvents(doneIds);
+            if (unauthorizedIds.length) await db.quarantineEvents(unauthorizedIds);
         }
+    } catch (e) {
+        console.error("Sync failed", e);
+    } finally {
+        syncing = false;
+    }
+}
+
+// Offline label cache: pull only what changed since our last version
+async function syncLabels() {
+    const version = localStorage.getItem('labelsVersion');
+    const headers = {};
+    if (version) headers['If-None-Match'] = `W/"labels-${version}"`;
+
+    try {
+        const res = await fetch(`/api/labels/sync?since=${version || 0}`, { headers });
+        if (res.status === 304 || !res.ok) return;
+
+        const feed = await res.json();
+        await db.applyLabelFeed(feed);
+        localStorage.setItem('labelsVersion', feed.version);
+        console.log(`Label cache ${feed.full ? 'reloaded' : 'updated'} to version ${feed.version}`);
+    } catch (e) {
+        console.error("Label sync failed", e);
     }
 }
 
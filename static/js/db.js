@@ -56,6 +56,23 @@ class DB {
         });
     }
 
+    // Applies a /api/labels/sync feed in a single transaction
+    async applyLabelFeed(feed) {
+        return new Promise((resolve, reject) => {
+            const transaction = this.db.transaction(['labels'], 'readwrite');
+            const store = transaction.objectStore('labels');
+
+            if (feed.full) {
+                store.clear();
+            }
+            feed.labels.forEach(([label_id, bound_serial_norm]) => store.put({ label_id, bound_serial_norm }));
+            feed.deleted.forEach(labelId => store.delete(labelId));
+
+            transaction.oncomplete = () => resolve();
+            transaction.onerror = () => reject(transaction.error);
+        });
+    }
+
     async queueEvent(eventData) {
         return new Promise((resolve, reject) => {
             // Add a UUID if not present
@@ -92,6 +109,34 @@ class DB {
             request.onerror = () => reject(request.error);
         });
     }
+
+    async quarantineEvents(eventIds) {
+        // Kept, but skipped by sync until their own employee logs in again
+        return new Promise((resolve, reject) => {
+            const transaction = this.db.transaction(['events'], 'readwrite');
+            const store = transaction.objectStore('events');
+            eventIds.forEach(id => {
+                const request = store.get(id);
+                request.onsuccess = () => {
+                    if (request.result) store.put({ ...request.result, quarantined: true });
+                };
+            });
+
+            transaction.oncomplete = () => resolve();
+            transaction.onerror = () => reject(transaction.error);
+        });
+    }
+
+    async clearEvents(eventIds) {
+        return new Promise((resolve, reject) => {
+            const transaction = this.db.transaction(['events'], 'readwrite');
+            const store = transaction.objectStore('events');
+            eventIds.forEach(id => store.delete(id));
+
+            transaction.oncomplete = () => resolve();
+            transaction.onerror = () => reject(transaction.error);
+        });
+    }
 }
 
 const db = new DB();
@@ -4,11 +4,21 @@ import db from './db.js';
 
 const list = document.getElementById('logs-list');
 const refreshBtn = document.getElementById('refresh-btn');
+const loadMoreBtn = document.getElementById('load-more-btn');
 
-async function loadLogs() {
-    list.innerHTML = '<p style="text-align: center;">Loading...</p>';
+// Groups loaded so far, keyed by device serial, and the cursor for the next (older) page
+let loadedGroups = new Map();
+let nextCursor = null;
 
-    const employeeCode = localStorage.getItem('employeeCode');
+async function loadLogs(more = false) {
+    if (!more) {
+        list.innerHTML = '<p style="text-align: center;">Loading...</p>';
+        loadedGroups = new Map();
+        nextCursor = null;
+    }
+    loadMoreBtn.classList.add('hidden');
+
+    const sessionToken = localStorage.getItem('sessionToken');
 
     if (!navigator.onLine) {
         list.innerHTML = '<p style="text-align: center; color: red;">Offline Access Denied.<br>Only authorized staff can view history (online only).</p>';
@@ -16,12 +26,16 @@ async function loadLogs() {
     }
 
     try {
-        const res = await fetch('/api/history/grouped', {
-            headers: {
-                'X-Employee-Code': employeeCode || ''
-            }
+        const url = more && nextCursor ? `/api/history/grouped?cursor=${encodeURIComponent(nextCursor)}` : '/api/history/grouped';
+        const res = await fetch(url, {
+            headers: sessionToken ? { 'Authorization': `Bearer ${sessionToken}` } : {}
         });
 
+        if (res.status === 401) {
+            list.innerHTML = '<p style="text-align: center; color: red;">Please log in again to view logs.</p>';
+            return;
+        }
+
         if (res.status === 403) {
             list.innerHTML = '<p style="text-align: center; color: red;">Access Denied.<br>You do not have permission to view logs.</p>';
             return;
@@ -29,7 +43,20 @@ async function loadLogs() {
 
         if (res.ok) {
             const groups = await res.json();
-            renderGroupedLogs(groups);
+            nextCursor = res.headers.get('X-Next-Cursor');
+
+            // A device can span pages: append its older logs to the existing group
+            groups.forEach(g => {
+                const existing = loadedGroups.get(g.device_serial_norm);
+                if (existing) {
+                    existing.access_logs.push(...g.access_logs);
+                } else {
+                    loadedGroups.set(g.device_serial_norm, g);
+                }
+            });
+
+            renderGroupedLogs(Array.from(loadedGroups.values()));
+            if (nextCursor) loadMoreBtn.classList.remove('hidden');
         } else {
             list.innerHTML = '<p style="text-align: center;">Failed to load logs.</p>';
         }
@@ -100,5 +127,6 @@ function renderGroupedLogs(groups) {
     });
 }
 
-refreshBtn.addEventListener('click', loadLogs);
-document.addEventListener('DOMContentLoaded', loadLogs);
+refreshBtn.addEventListener('click', () => loadLogs());
+loadMoreBtn.addEventListener('click', () => loadLogs(true));
+document.addEventListener('DOMContentLoaded', () => loadLogs());
@@ -1,32 +1,69 @@
-const CACHE_NAME = 'hospital-verify-v1';
-const ASSETS_TO_CACHE = [
-    '/',
-    '/static/index.html',
-    '/static/admin.html',
-    '/static/logs.html',
-    '/static/css/style.css',
-    '/static/js/app.js',
-    '/static/js/db.js',
-    '/static/manifest.json',
-    '/static/vendor/html5-qrcode.min.js',
-    '/static/vendor/tesseract.min.js',
-    '/static/vendor/worker.min.js',
-    '/static/vendor/tesseract-core.wasm.js',
-    '/static/vendor/tesseract-core.wasm.wasm'
-];
+// ASSET_MANIFEST is regenerated by scripts/build_assets.py: assets maps each
+// logical URL to its content-hashed URL. The "dev" copy below is the unbuilt one.
+const ASSET_MANIFEST = {
+    "version": "dev",
+    "pages": ["/", "/admin", "/logs"],
+    "assets": {
+        "/static/css/style.css": "/static/css/style.css",
+        "/static/js/admin.js": "/static/js/admin.js",
+        "/static/js/app.js": "/static/js/app.js",
+        "/static/js/db.js": "/static/js/db.js",
+        "/static/js/logs.js": "/static/js/logs.js",
+        "/static/manifest.json": "/static/manifest.json",
+        "/static/vendor/html5-qrcode.min.js": "/static/vendor/html5-qrcode.min.js",
+        "/static/vendor/qrcode.js": "/static/vendor/qrcode.js",
+        "/static/vendor/tesseract.min.js": "/static/vendor/tesseract.min.js"
+    }
+};
+const DEV = ASSET_MANIFEST.version === 'dev';
+const HASHED = new Set(Object.values(ASSET_MANIFEST.assets));
+
+// One long-lived cache for hashed assets: a URL never changes content, so an
+// install only downloads URLs that aren't cached yet.
+const ASSET_CACHE = 'hospital-verify-assets';
+const PAGE_CACHE = 'hospital-verify-pages';
 
 self.addEventListener('install', (event) => {
-    event.waitUntil(
-        caches.open(CACHE_NAME)
-            .then((cache) => {
-                return cache.addAll(ASSETS_TO_CACHE);
-            })
-    );
+    event.waitUntil((async () => {
+        const cache = await caches.open(ASSET_CACHE);
+        const cached = new Set((await cache.keys()).map(req => new URL(req.url).pathname));
+        const missing = [...HASHED].filter(url => !cached.has(url));
+        // Individually, so one missing optional vendor file doesn't abort the install
+        await Promise.all(missing.map(url => cache.add(url).catch(err => console.warn('Precache failed', url, err))));
+
+        const pages = await caches.open(PAGE_CACHE);
+        await Promise.all(ASSET_MANIFEST.pages.map(url => pages.add(url).catch(() => { })));
+        self.skipWaiting();
+    })());
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        // Drop caches from older service worker versions
+        const names = await caches.keys();
+        await Promise.all(names
+            .filter(name => name !== ASSET_CACHE && name !== PAGE_CACHE)
+            .map(name => caches.delete(name)));
+
+        // Drop assets no longer referenced by the manifest
+        const cache = await caches.open(ASSET_CACHE);
+        const requests = await cache.keys();
+        await Promise.all(requests
+            .filter(req => !HASHED.has(new URL(req.url).pathname))
+            .map(req => cache.delete(req)));
+        await self.clients.claim();
+    })());
 });
 
 self.addEventListener('fetch', (event) => {
+    const url = new URL(event.request.url);
+
+    if (event.request.method !== 'GET' && url.pathname.includes('/api/')) {
+        return;
+    }
+
     // Network first for API, Cache first for statics
-    if (event.request.url.includes('/api/')) {
+    if (url.pathname.includes('/api/')) {
         event.respondWith(
             fetch(event.request)
                 .catch(() => {
@@ -36,26 +73,28 @@ self.addEventListener('fetch', (event) => {
                     });
                 })
         );
+    } else if (event.request.mode === 'navigate') {
+        // Pages point at the current hashed assets, so prefer a fresh copy
+        event.respondWith(
+            fetch(event.request)
+                .then((response) => {
+                    const copy = response.clone();
+                    caches.open(PAGE_CACHE).then(cache => cache.put(url.pathname, copy));
+                    return response;
+                })
+                .catch(() => caches.match(url.pathname, { cacheName: PAGE_CACHE }))
+        );
+    } else if (DEV) {
+        // Unbuilt files keep their URL across edits, so don't pin them
+        event.respondWith(fetch(event.request).catch(() => caches.match(event.request)));
     } else {
+        // Requests by logical name (e.g. from vendor code) resolve to the current hashed copy
+        const target = ASSET_MANIFEST.assets[url.pathname] || url.pathname;
         event.respondWith(
-            caches.match(event.request)
+            caches.match(target, { cacheName: ASSET_CACHE })
                 .then((response) => {
-                    return response || fetch(event.request);
+                    return response || fetch(HASHED.has(target) ? target : event.request);
                 })
         );
     }
 });
-
-self.addEventListener('activate', (event) => {
-    event.waitUntil(
-        caches.keys().then((cacheNames) => {
-            return Promise.all(
-                cacheNames.map((cacheName) => {
-                    if (cacheName !== CACHE_NAME) {
-                        return caches.delete(cacheName);
-                    }
-                })
-            );
-        })
-    );
-});
@@ -0,0 +1,125 @@
+import os
+import json
+import mimetypes
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+
+STATIC_DIR = os.path.join(os.path.dirname(__file__), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+
+mimetypes.add_type("application/wasm", ".wasm")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Stable URLs (pages, sw.js, logical asset names) are revalidated with the ETag
+REVALIDATE = "no-cache"
+SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in (t.strip().removeprefix("W/") for t in header.split(","))
+
+
+class BuiltAssets:
+    """Serves static/dist as written by scripts/build_assets.py.
+
+    Picks the smallest precompressed variant the client accepts (identity for
+    Range requests, so byte offsets stay meaningful), answers If-None-Match
+    with 304 and marks content-hashed URLs immutable. Falls back to plain
+    StaticFiles over static/ when no build exists, e.g. in development.
+    """
+
+    def __init__(self, dist_dir=DIST_DIR, static_dir=STATIC_DIR):
+        self.dist_dir = dist_dir
+        self.manifest = load_manifest(os.path.join(dist_dir, 'asset-manifest.json'))
+        self.files = self.manifest["files"] if self.manifest else {}
+        self.fallback = StaticFiles(directory=static_dir)
+
+    @property
+    def built(self):
+        return self.manifest is not None
+
+    def response(self, path, headers):
+        entry = self.files.get(path)
+        if entry is None:
+            return None
+
+        encoding = None
+        if "range" not in headers:
+            accepted = accepted_encodings(headers.get("accept-encoding"))
+            encoding = next((e for e in entry["encodings"] if e in accepted), None)
+
+        etag = f'"{entry["etag"]}-{encoding}"' if encoding else f'"{entry["etag"]}"'
+        response_headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE if entry["immutable"] else REVALIDATE,
+        }
+        if entry["encodings"]:
+            response_headers["Vary"] = "Accept-Encoding"
+        if path == "js/sw.js":
+            # Registered from /static/js/ but controls the whole app
+            response_headers["Service-Worker-Allowed"] = "/"
+
+        if etag_matches(headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=response_headers)
+
+        file_path = os.path.join(self.dist_dir, *entry["file"].split("/"))
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if encoding:
+            file_path += SUFFIXES[encoding]
+            response_headers["Content-Encoding"] = encoding
+        return FileResponse(file_path, media_type=media_type, headers=response_headers)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] in ("GET", "HEAD"):
+            path, root_path = scope["path"], scope.get("root_path", "")
+            if root_path and path.startswith(root_path):
+                path = path[len(root_path):]
+            path = path.lstrip("/")
+            response = None
+            if self.built:
+                headers = {k.decode("latin-1"): v.decode("latin-1") for k, v in scope["headers"]}
+                response = self.response(path, headers)
+            elif path == "js/sw.js":
+                response = FileResponse(
+                    os.path.join(self.fallback.directory, "js", "sw.js"),
+                    headers={"Cache-Control": REVALIDATE, "Service-Worker-Allowed": "/"},
+                )
+            if response is not None:
+                await response(scope, receive, send)
+                return
+        await self.fallback(scope, receive, send)
+
+
+assets = BuiltAssets()
+
+
+def page(name, headers):
+    """Response for a top-level page, from the build when there is one."""
+    if assets.built:
+        response = assets.response(name, headers)
+        if response is not None:
+            return response
+    return FileResponse(os.path.join(STATIC_DIR, name), headers={"Cache-Control": REVALIDATE})